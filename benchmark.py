@@ -0,0 +1,379 @@
+"""Load test for the grading server, run against local stand-ins for OpenAI and Google Custom Search.
+
+Starts a stub LLM server and a stub search server with configurable latency, jitter and
+error rate, starts server.py against them, then drives the tool endpoints at each
+concurrency level and reports throughput, latency percentiles and the average
+Server-Timing stages. Results are printed and written as JSON, so runs can be compared.
+
+    python benchmark.py
+    python benchmark.py --concurrency 1,16,64 --requests 400 --llm-latency 0.8 --output results.json
+    python benchmark.py --scenarios grade_text,tool_grade_text --cache-mode hit
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import uuid
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+ESSAY = """Climate change is one of the defining challenges of this century. Rising global temperatures
+are driven mainly by greenhouse gas emissions from burning fossil fuels. The consequences include
+more frequent heatwaves, rising sea levels and pressure on food and water supplies. Governments can
+respond with carbon pricing, investment in renewable energy and adaptation measures for vulnerable
+regions, while individuals can reduce their own footprint through transport and energy choices."""
+
+RUBRIC = """Content (40 points): Depth and accuracy of the argument
+Organization (30 points): Logical structure and flow
+Language (30 points): Grammar, clarity and academic style"""
+
+STUB_GRADE_FEEDBACK = {
+    "grade": "B+",
+    "criteria": [
+        {"criterion": "Content", "score": "34/40", "comment": "Accurate but could go deeper."},
+        {"criterion": "Organization", "score": "26/30", "comment": "Clear structure."},
+        {"criterion": "Language", "score": "27/30", "comment": "Mostly fluent."},
+    ],
+    "feedback": "A clear, well-organized essay. Support the policy claims with evidence.",
+}
+STUB_COMPLETION = "B+ A clear, well-organized essay. Support the policy claims with evidence."
+
+# Scenario name -> (route, kind of request body)
+SCENARIOS = {
+    "grade_text": ("/tools/grade_text", "grading"),
+    "generate_feedback": ("/tools/generate_feedback", "grading"),
+    "grade_and_feedback": ("/tools/grade_and_feedback", "grading"),
+    "grade_text_stream": ("/tools/grade_text/stream", "grading"),
+    "check_plagiarism": ("/tools/check_plagiarism", "plagiarism"),
+    "tool_grade_text": ("/tool/grade_text", "grading"),
+    "tool_grade_and_feedback": ("/tool/grade_and_feedback", "grading"),
+    "tool_check_plagiarism": ("/tool/check_plagiarism", "plagiarism"),
+}
+DEFAULT_SCENARIOS = "grade_text,grade_and_feedback,check_plagiarism,tool_grade_text,tool_check_plagiarism"
+
+# ==== 🧪 Stub Upstreams ====
+def make_stub_app(latency: float, jitter: float, error_rate: float) -> FastAPI:
+    """OpenAI chat completions and Custom Search stand-in with random latency and failures"""
+    app = FastAPI()
+
+    async def delay():
+        await asyncio.sleep(max(0.0, latency + random.uniform(-jitter, jitter)))
+
+    def failure():
+        if random.random() >= error_rate:
+            return None
+        # Half of the failures are rate limits with a short Retry-After, half server errors
+        if random.random() < 0.5:
+            return JSONResponse({"error": {"message": "Rate limit reached", "type": "requests",
+                                           "code": "rate_limit_exceeded"}},
+                                status_code=429, headers={"retry-after": "0.1"})
+        return JSONResponse({"error": {"message": "The server had an error", "type": "server_error"}},
+                            status_code=500)
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        await delay()
+        error = failure()
+        if error is not None:
+            return error
+
+        json_output = (body.get("response_format") or {}).get("type") == "json_object"
+        content = json.dumps(STUB_GRADE_FEEDBACK) if json_output else STUB_COMPLETION
+        prompt_tokens = sum(len(m["content"]) for m in body["messages"]) // 4
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content) // 4,
+                 "total_tokens": prompt_tokens + len(content) // 4}
+        base = {"id": "chatcmpl-stub", "created": int(time.time()), "model": body["model"]}
+
+        if body.get("stream"):
+            async def events():
+                for word in content.split(" "):
+                    chunk = {**base, "object": "chat.completion.chunk",
+                             "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}]}
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                final = {**base, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+                yield f"data: {json.dumps(final)}\n\n"
+                yield "data: [DONE]\n\n"
+            return StreamingResponse(events(), media_type="text/event-stream")
+
+        return {**base, "object": "chat.completion", "usage": usage, "choices": [
+            {"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}
+        ]}
+
+    @app.get("/customsearch/v1")
+    async def custom_search(q: str):
+        await delay()
+        error = failure()
+        if error is not None:
+            return error
+
+        # The first result quotes the query; the others shuffle its words
+        words = q.strip('"').split()
+        return {"items": [
+            {"link": f"https://example.com/{i}/{abs(hash(q)) % 997}",
+             "snippet": " ".join(random.sample(words, len(words)) if i else words)}
+            for i in range(10)
+        ]}
+
+    return app
+
+# ==== 🚀 Processes ====
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+def start_process(command: List[str], env: Dict[str, str] = None, log_path: str = None) -> subprocess.Popen:
+    log = open(log_path, "w") if log_path else subprocess.DEVNULL
+    return subprocess.Popen(command, cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+def start_stub(latency: float, jitter: float, error_rate: float) -> Tuple[int, subprocess.Popen]:
+    port = free_port()
+    process = start_process([sys.executable, os.path.abspath(__file__), "--stub", str(port),
+                             "--stub-latency", str(latency), "--stub-jitter", str(jitter),
+                             "--stub-error-rate", str(error_rate)])
+    return port, process
+
+def wait_ready(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Process for {url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1)
+            return
+        except httpx.HTTPError:
+            time.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up within {timeout:g}s")
+
+def git_commit() -> str:
+    try:
+        result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True, text=True)
+        return result.stdout.strip() or None
+    except OSError:
+        return None
+
+# ==== 📊 Load Driver ====
+def percentile(sorted_values: List[float], q: float) -> float:
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(q / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def parse_server_timing(header: str) -> Dict[str, float]:
+    timings = {}
+    for entry in (header or "").split(","):
+        name, _, params = entry.strip().partition(";")
+        if name and params.startswith("dur="):
+            timings[name] = float(params[len("dur="):])
+    return timings
+
+def request_body(kind: str, text: str) -> Dict:
+    if kind == "plagiarism":
+        return {"text": text, "similarity_threshold": 0}
+    return {"text": text, "rubric": RUBRIC, "model": "gpt-3.5-turbo"}
+
+def submission_text(cache_mode: str, tag: str) -> str:
+    """The shared essay, made unique per request unless every request should hit the caches.
+    
+    Every sentence gets its own rare marker word, so whichever passages plagiarism checking
+    picks, their search queries differ from those of every other request too.
+    """
+    if cache_mode == "hit":
+        return ESSAY
+    token = uuid.uuid4().hex[:10]
+    sentences = re.split(r"(?<=\.)\s+", ESSAY)
+    marked = " ".join(f"{sentence[:-1]} q{token}{i}." for i, sentence in enumerate(sentences))
+    return f"{marked}\nSubmission {tag} reviewed under reference {token} with marker q{token[::-1]}."
+
+async def run_level(client: httpx.AsyncClient, scenario: str, concurrency: int, total: int,
+                    cache_mode: str) -> Dict:
+    """Send total requests for a scenario with concurrency requests in flight at any time"""
+    path, kind = SCENARIOS[scenario]
+    if cache_mode == "hit":
+        await client.post(path, json=request_body(kind, submission_text(cache_mode, "warmup")))
+
+    latencies: List[float] = []
+    statuses = Counter()
+    stage_totals = defaultdict(float)
+    stage_counts = Counter()
+    pending = iter(range(total))
+
+    async def worker():
+        for i in pending:
+            body = request_body(kind, submission_text(cache_mode, f"{scenario}-{concurrency}-{i}"))
+            start = time.perf_counter()
+            try:
+                response = await client.post(path, json=body)
+                status = str(response.status_code)
+                # Streaming endpoints report failures in an error event
+                if response.status_code == 200 and "event: error" in response.text:
+                    status = "stream_error"
+                for stage, ms in parse_server_timing(response.headers.get("server-timing")).items():
+                    stage_totals[stage] += ms
+                    stage_counts[stage] += 1
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            latencies.append(time.perf_counter() - start)
+            statuses[status] += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    errors = sum(count for status, count in statuses.items() if status != "200")
+    return {
+        "scenario": scenario,
+        "route": path,
+        "concurrency": concurrency,
+        "requests": total,
+        "elapsed_s": round(elapsed, 3),
+        "throughput_rps": round(total / elapsed, 2),
+        "error_rate": round(errors / total, 4),
+        "status_codes": dict(statuses),
+        "latency_ms": {
+            "mean": round(sum(latencies) / len(latencies) * 1000, 2),
+            "p50": round(percentile(latencies, 50) * 1000, 2),
+            "p90": round(percentile(latencies, 90) * 1000, 2),
+            "p99": round(percentile(latencies, 99) * 1000, 2),
+            "max": round(latencies[-1] * 1000, 2),
+        },
+        "server_timing_ms": {stage: round(stage_totals[stage] / stage_counts[stage], 3) for stage in stage_totals},
+    }
+
+async def drive(base_url: str, args) -> List[Dict]:
+    results = []
+    max_concurrency = max(args.concurrency)
+    limits = httpx.Limits(max_connections=max_concurrency, max_keepalive_connections=max_concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=args.timeout, limits=limits) as client:
+        for scenario in args.scenarios:
+            for concurrency in args.concurrency:
+                result = await run_level(client, scenario, concurrency, args.requests, args.cache_mode)
+                latency = result["latency_ms"]
+                print(f"{scenario:<24} c={concurrency:<4} {result['throughput_rps']:>8.1f} req/s  "
+                      f"p50={latency['p50']:>8.1f}ms  p90={latency['p90']:>8.1f}ms  p99={latency['p99']:>8.1f}ms  "
+                      f"errors={result['error_rate']:.1%}")
+                results.append(result)
+    return results
+
+# ==== ▶️ Main ====
+def parse_args():
+    parser = argparse.ArgumentParser(description="Benchmark the grading server against local stub upstreams")
+    parser.add_argument("--concurrency", default="1,8,32",
+                        help="Comma-separated concurrency levels (default: 1,8,32)")
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and level (default: 200)")
+    parser.add_argument("--scenarios", default=DEFAULT_SCENARIOS,
+                        help=f"Comma-separated scenarios or 'all' (available: {', '.join(SCENARIOS)})")
+    parser.add_argument("--cache-mode", choices=("miss", "hit"), default="miss",
+                        help="miss: every submission is unique; hit: the same submission is repeated")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="Stub LLM latency in seconds")
+    parser.add_argument("--llm-jitter", type=float, default=0.1, help="Stub LLM latency jitter (+/- seconds)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="Fraction of stub LLM calls that fail")
+    parser.add_argument("--search-latency", type=float, default=0.2, help="Stub search latency in seconds")
+    parser.add_argument("--search-jitter", type=float, default=0.05, help="Stub search latency jitter (+/- seconds)")
+    parser.add_argument("--search-error-rate", type=float, default=0.0, help="Fraction of stub searches that fail")
+    parser.add_argument("--workers", type=int, default=1, help="Server worker processes (default: 1)")
+    parser.add_argument("--keep-rate-limits", action="store_true",
+                        help="Keep the server's upstream rate limits (by default they are lifted)")
+    parser.add_argument("--timeout", type=float, default=120, help="Client timeout per request in seconds")
+    parser.add_argument("--output", default="benchmark_results.json", help="Where to write the JSON results")
+    # Internal: run a stub upstream server on this port
+    parser.add_argument("--stub", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--stub-latency", type=float, default=0.0, help=argparse.SUPPRESS)
+    parser.add_argument("--stub-jitter", type=float, default=0.0, help=argparse.SUPPRESS)
+    parser.add_argument("--stub-error-rate", type=float, default=0.0, help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+    args.concurrency = [int(level) for level in args.concurrency.split(",")]
+    args.scenarios = list(SCENARIOS) if args.scenarios == "all" else args.scenarios.split(",")
+    unknown = [scenario for scenario in args.scenarios if scenario not in SCENARIOS]
+    if unknown:
+        parser.error(f"Unknown scenarios: {', '.join(unknown)}")
+    return args
+
+def main():
+    args = parse_args()
+    if args.stub:
+        app = make_stub_app(args.stub_latency, args.stub_jitter, args.stub_error_rate)
+        uvicorn.run(app, host="127.0.0.1", port=args.stub, log_level="warning", access_log=False)
+        return
+
+    workdir = tempfile.mkdtemp(prefix="grader-benchmark-")
+    processes = []
+    try:
+        llm_port, llm = start_stub(args.llm_latency, args.llm_jitter, args.llm_error_rate)
+        search_port, search = start_stub(args.search_latency, args.search_jitter, args.search_error_rate)
+        processes += [llm, search]
+
+        server_port = free_port()
+        env = {
+            **os.environ,
+            "OPENAI_API_KEY": "sk-benchmark",
+            "GOOGLE_API_KEY": "benchmark",
+            "SEARCH_ENGINE_ID": "benchmark",
+            "OPENAI_BASE_URL": f"http://127.0.0.1:{llm_port}/v1",
+            "GOOGLE_SEARCH_URL": f"http://127.0.0.1:{search_port}/customsearch/v1",
+            "GOOGLE_DAILY_QUOTA": "0",
+            "WORKERS": str(args.workers),
+            # Fresh caches for every run
+            "CACHE_DIR": os.path.join(workdir, "cache"),
+        }
+        if not args.keep_rate_limits:
+            env.update(OPENAI_RPM="0", OPENAI_TPM="0", GOOGLE_QPM="0")
+        server_log = os.path.join(workdir, "server.log")
+        server = start_process([sys.executable, "-m", "uvicorn", "server:app", "--host", "127.0.0.1",
+                                "--port", str(server_port), "--workers", str(args.workers),
+                                "--log-level", "warning", "--no-access-log"],
+                               env=env, log_path=server_log)
+        processes.append(server)
+
+        wait_ready(f"http://127.0.0.1:{llm_port}/docs", llm)
+        wait_ready(f"http://127.0.0.1:{search_port}/docs", search)
+        wait_ready(f"http://127.0.0.1:{server_port}/", server)
+
+        started_at = datetime.now().isoformat(timespec="seconds")
+        results = asyncio.run(drive(f"http://127.0.0.1:{server_port}", args))
+
+        report = {
+            "started_at": started_at,
+            "git_commit": git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "config": {key: value for key, value in vars(args).items() if not key.startswith("stub")},
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -2,7 +2,6 @@ import streamlit as st
 import requests
 import json
 import os
-import tempfile
 import time
 import logging
 from dotenv import load_dotenv
@@ -163,10 +162,148 @@ st.session_state['openai_api_key'] = OPENAI_API_KEY
 st.session_state['google_api_key'] = GOOGLE_API_KEY
 st.session_state['google_cx'] = GOOGLE_CX
 
+def upload_file(uploaded_file):
+    """Send an uploaded file to the API server for parsing; returns its document ID and text."""
+    url = f"{st.session_state['api_server_url']}/tools/upload_file"
+    logger.info(f"Uploading {uploaded_file.name}")
+    
+    try:
+        response = requests.post(
+            url,
+            params={"filename": uploaded_file.name},
+            data=uploaded_file.getvalue(),
+            headers={"Content-Type": "application/octet-stream"},
+            timeout=120
+        )
+        
+        if response.status_code != 200:
+            error_message = f"Error {response.status_code} from server: {response.text}"
+            logger.error(error_message)
+            st.error(error_message)
+            return None
+        
+        return response.json()
+    except Exception as e:
+        error_message = f"Error connecting to server: {str(e)}"
+        logger.error(error_message)
+        st.error(error_message)
+        return None
+
+def register_rubric(rubric):
+    """Register a rubric with the API server and return its rubric ID (None if that fails)."""
+    url = f"{st.session_state['api_server_url']}/rubrics"
+    
+    try:
+        response = requests.post(url, json={"rubric": rubric}, timeout=30)
+        if response.status_code != 200:
+            logger.error(f"Error {response.status_code} registering rubric: {response.text}")
+            return None
+        return response.json().get('rubric_id')
+    except Exception as e:
+        logger.error(f"Error connecting to server: {str(e)}")
+        return None
+
+def parse_server_timing(header):
+    """Turn a Server-Timing header ("upstream;dur=512.3, ...") into {stage: milliseconds}."""
+    timings = {}
+    for entry in (header or "").split(","):
+        name, _, params = entry.strip().partition(";")
+        if name and params.startswith("dur="):
+            try:
+                timings[name] = float(params[len("dur="):])
+            except ValueError:
+                pass
+    return timings
+
+def record_timings(tool_name, timings):
+    """Keep the server's stage timings of the last call to each tool for the Results tab."""
+    if timings:
+        st.session_state.setdefault('timings', {})[tool_name] = timings
+
+# Background jobs are polled until they finish or JOB_TIMEOUT seconds pass
+JOB_POLL_INTERVAL = 1
+JOB_TIMEOUT = 900
+
+def wait_for_job(job_id, tool_name=None):
+    """Poll a background job on the API server and return its result."""
+    job_url = f"{st.session_state['api_server_url']}/jobs/{job_id}"
+    deadline = time.time() + JOB_TIMEOUT
+    
+    while time.time() < deadline:
+        status = requests.get(job_url, timeout=10).json()
+        if status.get("status") in ("succeeded", "failed"):
+            break
+        time.sleep(JOB_POLL_INTERVAL)
+    else:
+        error_message = f"Job {job_id} did not finish within {JOB_TIMEOUT} seconds"
+        logger.error(error_message)
+        st.error(error_message)
+        return None
+    
+    record_timings(tool_name or status.get("tool"), status.get("timings"))
+    response = requests.get(f"{job_url}/result", timeout=60)
+    if response.status_code != 200:
+        error_message = f"Error {response.status_code} from server: {response.text}"
+        logger.error(error_message)
+        st.error(error_message)
+        return None
+    
+    try:
+        return response.json()
+    except json.JSONDecodeError:
+        return response.text
+
+def stream_api_tool(tool_name, data):
+    """Call a streaming tool on the API server and yield its text as it arrives."""
+    url = f"{st.session_state['api_server_url']}/tools/{tool_name}/stream"
+    
+    request_data = data.copy()
+    request_data["openai_api_key"] = OPENAI_API_KEY
+    request_data["google_api_key"] = GOOGLE_API_KEY
+    request_data["search_engine_id"] = GOOGLE_CX
+    
+    logger.info(f"Streaming {tool_name}")
+    
+    try:
+        with requests.post(url, json=request_data, stream=True, timeout=(10, 300)) as response:
+            # Only stages finished before the stream starts are in the header
+            record_timings(tool_name, parse_server_timing(response.headers.get("Server-Timing")))
+            if response.status_code != 200:
+                error_message = f"Error {response.status_code} from server: {response.text}"
+                logger.error(error_message)
+                st.error(error_message)
+                return
+            
+            # Server-sent events: "event: <name>" followed by "data: <json>"
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith("event:"):
+                    event = line[len("event:"):].strip()
+                elif line.startswith("data:"):
+                    payload = json.loads(line[len("data:"):])
+                    if event == "token":
+                        yield payload["text"]
+                    elif event == "error":
+                        error_message = f"Error {payload.get('status_code')} from server: {payload.get('detail')}"
+                        logger.error(error_message)
+                        st.error(error_message)
+                        return
+    except Exception as e:
+        error_message = f"Error connecting to server: {str(e)}"
+        logger.error(error_message)
+        st.error(error_message)
+
 # Function to call API tools
-def call_api_tool(tool_name, data):
-    """Call a tool on the API server with hardcoded API keys."""
-    url = f"{st.session_state['api_server_url']}/tools/{tool_name}"
+def call_api_tool(tool_name, data, background=False):
+    """Call a tool on the API server with hardcoded API keys.
+    
+    With background=True the call runs as a server-side job that is polled until it
+    finishes, so slow gradings are not cut off by the request timeout.
+    """
+    if background:
+        url = f"{st.session_state['api_server_url']}/jobs/{tool_name}"
+    else:
+        url = f"{st.session_state['api_server_url']}/tools/{tool_name}"
     
     # Create a copy of the data
     request_data = data.copy()
@@ -196,11 +333,16 @@ def call_api_tool(tool_name, data):
             timeout=60
         )
         
-        if response.status_code != 200:
+        if response.status_code not in (200, 202):
             error_message = f"Error {response.status_code} from server: {response.text}"
             logger.error(error_message)
             st.error(error_message)
             return None
+        
+        if background:
+            return wait_for_job(response.json()["job_id"], tool_name)
+        
+        record_timings(tool_name, parse_server_timing(response.headers.get("Server-Timing")))
             
         try:
             return response.json()
@@ -357,12 +499,6 @@ with tab1:
             <p style='margin-bottom: 0;'><strong>Uploaded:</strong> {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}</p>
         </div>""", unsafe_allow_html=True)
         
-        # Save the uploaded file temporarily
-        with tempfile.NamedTemporaryFile(delete=False, suffix=os.path.splitext(uploaded_file.name)[1]) as tmp_file:
-            tmp_file.write(uploaded_file.getvalue())
-            file_path = tmp_file.name
-        
-        st.session_state['file_path'] = file_path
         st.session_state['file_name'] = uploaded_file.name
         
         # Process button below the file information
@@ -383,7 +519,10 @@ with tab1:
         # Parse the document
         if process_button:
                 with st.spinner("Processing document..."):
-                    result = call_api_tool("parse_file", {"file_path": file_path})
+                    upload = upload_file(uploaded_file)
+                    result = upload.get('text') if isinstance(upload, dict) else upload
+                    if isinstance(upload, dict):
+                        st.session_state['document_id'] = upload.get('document_id')
                     
                     if result is None:
                         st.error("Failed to process document. Check server connection.")
@@ -419,7 +558,7 @@ with tab1:
                         if word_count > 5000:
                             st.markdown(f"""<div style='background-color: rgba(255, 152, 0, 0.1); padding: 15px; border-radius: 10px; border-left: 4px solid #ff9800; margin: 15px 0;'>
                                 <h4 style='margin-top: 0; color: #ff9800;'>⚠️ Warning</h4>
-                                <p style='margin-bottom: 0;'>Long document detected ({word_count} words). Processing might take longer.</p>
+                                <p style='margin-bottom: 0;'>Long document detected ({word_count} words). It will be graded section by section.</p>
                             </div>""", unsafe_allow_html=True)
                     else:
                         # If result is a dict, might be error information
@@ -516,6 +655,18 @@ Language & Style (20%): The language should be engaging, varied, and appropriate
             ["gpt-3.5-turbo", "gpt-4"],
             help="Select the AI model to use for grading (affects accuracy and cost)"
         )
+        
+        force_regrade = st.checkbox(
+            "Force fresh grading",
+            value=False,
+            help="Ignore previously cached grades and feedback for this document and rubric"
+        )
+        
+        stream_feedback = st.checkbox(
+            "Stream feedback live",
+            value=False,
+            help="Show the feedback as it is written instead of waiting for the full result"
+        )
     
     # Grade Assignment button with improved styling
     if 'document_text' in st.session_state:
@@ -556,38 +707,55 @@ Language & Style (20%): The language should be engaging, varied, and appropriate
                         "similarity_threshold": similarity_threshold if 'similarity_threshold' in locals() else 40
                     }
                     
-                    plagiarism_results = call_api_tool("check_plagiarism", plagiarism_data)
+                    plagiarism_results = call_api_tool("check_plagiarism", plagiarism_data, background=True)
                     st.session_state['plagiarism_results'] = plagiarism_results
                     
+                    # Compare against earlier submissions parsed by the server
+                    if st.session_state.get('document_id'):
+                        similar = call_api_tool("similar_submissions", {
+                            "document_id": st.session_state['document_id'],
+                            "min_similarity": (similarity_threshold if 'similarity_threshold' in locals() else 40) / 100
+                        })
+                        st.session_state['similar_submissions'] = similar
+                    
                     progress_bar.progress(33)
                 else:
                     progress_bar.progress(33)
                 
-                # Generate grade
-                st.info("🧮 Generating grade...")
-                
                 grade_data = {
                     "text": st.session_state['document_text'], 
-                    "rubric": rubric,
-                    "model": grade_model if 'grade_model' in locals() else "gpt-3.5-turbo"
+                    "model": grade_model if 'grade_model' in locals() else "gpt-3.5-turbo",
+                    "bypass_cache": force_regrade
                 }
                 
-                grade_results = call_api_tool("grade_text", grade_data)
-                st.session_state['grade_results'] = grade_results
-                
-                progress_bar.progress(66)
-                
-                # Generate feedback
-                st.info("✍️ Generating detailed feedback...")
-                
-                feedback_data = {
-                    "text": st.session_state['document_text'], 
-                    "rubric": rubric,
-                    "model": grade_model if 'grade_model' in locals() else "gpt-3.5-turbo"
-                }
+                # Send the rubric once and refer to it by ID; fall back to sending the text
+                if st.session_state.get('rubric_id_for') != rubric:
+                    st.session_state['rubric_id'] = register_rubric(rubric)
+                    st.session_state['rubric_id_for'] = rubric
+                if st.session_state.get('rubric_id'):
+                    grade_data["rubric_id"] = st.session_state['rubric_id']
+                else:
+                    grade_data["rubric"] = rubric
                 
-                feedback = call_api_tool("generate_feedback", feedback_data)
-                st.session_state['feedback'] = feedback
+                if stream_feedback:
+                    # Grade first, then render the feedback as it streams in
+                    st.info("🧮 Generating grade...")
+                    grade_results = call_api_tool("grade_text", grade_data, background=True)
+                    st.session_state['grade_results'] = grade_results
+                    
+                    progress_bar.progress(66)
+                    
+                    st.info("✍️ Generating detailed feedback...")
+                    feedback = st.write_stream(stream_api_tool("generate_feedback", grade_data)) or None
+                    st.session_state['feedback'] = feedback
+                else:
+                    # Generate grade and feedback in a single call
+                    st.info("🧮 Generating grade and detailed feedback...")
+                    grade_results = call_api_tool("grade_and_feedback", grade_data, background=True)
+                    st.session_state['grade_results'] = grade_results
+                    
+                    feedback = grade_results.get('feedback') if isinstance(grade_results, dict) else None
+                    st.session_state['feedback'] = feedback
                 
                 progress_bar.progress(100)
                 
@@ -668,6 +836,15 @@ with tab3:
             # st.markdown("""<div style='background-color: rgba(255, 255, 255, 0.05); padding: 20px; border-radius: 10px; border: 1px solid rgba(46, 125, 50, 0.2);'>""", unsafe_allow_html=True)
             st.markdown(st.session_state['feedback'])
             st.markdown("""</div>""", unsafe_allow_html=True)
+            
+            # Per-criterion scores from the structured grading result
+            criteria = st.session_state['grade_results'].get('criteria') if isinstance(st.session_state.get('grade_results'), dict) else None
+            if criteria:
+                with st.expander("Scores by Criterion", expanded=True):
+                    for item in criteria:
+                        st.markdown(f"**{item.get('criterion', '')}**: {item.get('score', '')}")
+                        if item.get('comment'):
+                            st.caption(item['comment'])
         else:
             st.warning("Feedback is not available.")
         
@@ -695,6 +872,12 @@ with tab3:
                         st.info(f"ℹ️ Moderate similarity ({similarity}%): [{url}]({url})")
                     else:
                         st.success(f"✅ Low similarity ({similarity}%): [{url}]({url})")
+                    
+                    # Show the part of the document that matched this source
+                    offset = item.get('chunk_offset')
+                    document_text = st.session_state.get('document_text', '')
+                    if offset is not None and similarity > 40 and document_text:
+                        st.caption(f"Matching passage: “{document_text[offset:offset + 250].strip()}…”")
             else:
                 # Old API format
                 st.markdown("**Similarity matches found:**")
@@ -709,6 +892,23 @@ with tab3:
                 else:
                     st.json(results)  # Display raw results if format is unknown
         
+        # Display matches against other submissions if available
+        similar = st.session_state.get('similar_submissions')
+        if isinstance(similar, dict) and similar.get('results'):
+            st.markdown("**Similar submissions from other students:**")
+            for item in similar['results']:
+                similarity = round(item.get('similarity', 0) * 100)
+                st.warning(f"⚠️ {similarity}% estimated overlap with submission `{item.get('document_id', '')[:12]}`")
+        
+        # Server-side time spent in each stage of the last calls
+        timings = st.session_state.get('timings')
+        if timings:
+            with st.expander("⏱️ Server Timing", expanded=False):
+                for tool_name, stages in timings.items():
+                    st.markdown(f"**{tool_name}**")
+                    st.bar_chart({stage: [ms] for stage, ms in stages.items() if stage != "total"}, horizontal=True)
+                    st.caption(" · ".join(f"{stage}: {ms:.1f} ms" for stage, ms in stages.items()))
+        
         # Export options with better styling
         st.markdown("""<div style='background-color: rgba(46, 125, 50, 0.1); padding: 15px; border-radius: 10px; margin: 20px 0 10px 0;'>
             <h3>💾 Export Options</h3>
@@ -1,12 +1,39 @@
-from fastapi import FastAPI, Request, HTTPException, Depends
+from fastapi import FastAPI, Request, Response, HTTPException, Depends
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import StreamingResponse, JSONResponse, ORJSONResponse
+from fastapi.routing import APIRoute
+from starlette.datastructures import MutableHeaders
 import uvicorn
 import openai
+import httpx
+import asyncio
+import bisect
+import hashlib
+import inspect
+import io
+import json
+import math
 import os
+import random
+import re
+import sqlite3
 import sys
-from pydantic import BaseModel
-from typing import Dict, Any, Optional, Union, List
-import requests
+import tempfile
+import threading
+import time
+import uuid
+import zlib
+from pydantic import BaseModel, ConfigDict, TypeAdapter, ValidationError
+from typing import Dict, Any, Optional, Union, List, Tuple, Callable, Awaitable
+from collections import Counter, OrderedDict, deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 from functools import lru_cache
+from zoneinfo import ZoneInfo
 import logging
 
 # Initialize logging
@@ -20,6 +47,92 @@ class Settings:
         self.google_api_key = os.environ.get("GOOGLE_API_KEY", "")
         self.search_engine_id = os.environ.get("SEARCH_ENGINE_ID", "")
         
+        # Worker processes started by `python server.py`; they share the SQLite stores in CACHE_DIR
+        self.workers = max(1, int(os.environ.get("WORKERS", "1")))
+        
+        # LLM client pool: max in-flight completions per worker and HTTP pool size per API key
+        self.llm_max_concurrency = int(os.environ.get("LLM_MAX_CONCURRENCY", "64"))
+        self.llm_max_connections = int(os.environ.get("LLM_MAX_CONNECTIONS", "100"))
+        self.llm_max_keepalive = int(os.environ.get("LLM_MAX_KEEPALIVE", "20"))
+        self.llm_timeout = float(os.environ.get("LLM_TIMEOUT", "120"))
+        # OpenAI-compatible API to call instead of api.openai.com (e.g. a local stub for benchmarks)
+        self.openai_base_url = os.environ.get("OPENAI_BASE_URL") or None
+        # Hedging: default second model, and the latency percentile of the first model after which it is
+        # raced against it (HEDGE_DELAY seconds until enough latencies have been seen)
+        self.hedge_model = os.environ.get("HEDGE_MODEL") or None
+        self.hedge_percentile = float(os.environ.get("HEDGE_PERCENTILE", "95"))
+        self.hedge_delay = float(os.environ.get("HEDGE_DELAY", "10"))
+        # Models tried in order when a completion fails (comma-separated), and the upstream retries
+        # of a model that still has a hedge or fallback model after it
+        self.fallback_models = [m.strip() for m in os.environ.get("FALLBACK_MODELS", "").split(",") if m.strip()]
+        self.fallback_max_retries = int(os.environ.get("FALLBACK_MAX_RETRIES", "1"))
+        
+        # Max Custom Search queries per plagiarism check
+        self.plagiarism_max_queries = int(os.environ.get("PLAGIARISM_MAX_QUERIES", "3"))
+        # Threads used by each similarity scoring call (-1 = all cores)
+        self.plagiarism_score_workers = int(os.environ.get("PLAGIARISM_SCORE_WORKERS", "-1"))
+        # Custom Search queries allowed per API key per day (0 = unlimited)
+        self.google_daily_quota = int(os.environ.get("GOOGLE_DAILY_QUOTA", "100"))
+        self.google_search_url = os.environ.get("GOOGLE_SEARCH_URL", "https://www.googleapis.com/customsearch/v1")
+        
+        # Shared HTTP client for other upstreams (Google Custom Search)
+        self.http_max_connections = int(os.environ.get("HTTP_MAX_CONNECTIONS", "50"))
+        self.http_max_keepalive = int(os.environ.get("HTTP_MAX_KEEPALIVE", "10"))
+        self.http_timeout = float(os.environ.get("HTTP_TIMEOUT", "10"))
+        
+        # Upstream rate limits per API key, per minute (0 = unlimited)
+        self.openai_rpm = int(os.environ.get("OPENAI_RPM", "3500"))
+        self.openai_tpm = int(os.environ.get("OPENAI_TPM", "200000"))
+        self.google_qpm = int(os.environ.get("GOOGLE_QPM", "100"))
+        # Retries of rate-limited or failed upstream calls, with exponential backoff (seconds)
+        self.upstream_max_retries = int(os.environ.get("UPSTREAM_MAX_RETRIES", "4"))
+        self.upstream_backoff = float(os.environ.get("UPSTREAM_BACKOFF", "1"))
+        self.upstream_backoff_max = float(os.environ.get("UPSTREAM_BACKOFF_MAX", "60"))
+        
+        # Document extraction process pool: worker count, per-file timeout and max queued files
+        self.parse_workers = int(os.environ.get("PARSE_WORKERS", str(max(1, (os.cpu_count() or 2) // self.workers))))
+        self.parse_timeout = float(os.environ.get("PARSE_TIMEOUT", "60"))
+        self.parse_max_queue = int(os.environ.get("PARSE_MAX_QUEUE", "32"))
+        
+        # Direct uploads: max file size, and size above which uploads are spooled to a temp file
+        self.upload_max_mb = int(os.environ.get("UPLOAD_MAX_MB", "50"))
+        self.upload_spool_mb = int(os.environ.get("UPLOAD_SPOOL_MB", "8"))
+        
+        # Caches: directory for disk tiers, parse cache sizes (disk tier disabled when 0, and on by
+        # default with several workers so they share parsed files)
+        self.cache_dir = os.environ.get("CACHE_DIR", ".grader_cache")
+        self.parse_cache_memory_mb = int(os.environ.get("PARSE_CACHE_MEMORY_MB", "64"))
+        self.parse_cache_disk_mb = int(os.environ.get("PARSE_CACHE_DISK_MB", "256" if self.workers > 1 else "0"))
+        
+        # Local similarity index of every parsed submission (set SIMILARITY_INDEX=0 to disable)
+        self.similarity_index = os.environ.get("SIMILARITY_INDEX", "1") != "0"
+        
+        # Grade/feedback result cache: entry lifetime in seconds and tier sizes
+        self.result_cache_ttl = float(os.environ.get("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+        self.result_cache_memory_mb = int(os.environ.get("RESULT_CACHE_MEMORY_MB", "32"))
+        self.result_cache_disk_mb = int(os.environ.get("RESULT_CACHE_DISK_MB", "256"))
+        
+        # Long documents: token count above which a text is graded section by section, and section size
+        self.long_document_tokens = int(os.environ.get("LONG_DOCUMENT_TOKENS", "6000"))
+        self.section_tokens = int(os.environ.get("SECTION_TOKENS", "3000"))
+        
+        # Custom Search result cache: entry lifetime in seconds and tier sizes
+        self.search_cache_ttl = float(os.environ.get("SEARCH_CACHE_TTL", str(7 * 24 * 3600)))
+        self.search_cache_memory_mb = int(os.environ.get("SEARCH_CACHE_MEMORY_MB", "16"))
+        self.search_cache_disk_mb = int(os.environ.get("SEARCH_CACHE_DISK_MB", "64"))
+        
+        # Batch grading: max submissions per batch and max items graded concurrently
+        self.batch_max_items = int(os.environ.get("BATCH_MAX_ITEMS", "500"))
+        self.batch_max_concurrency = int(os.environ.get("BATCH_MAX_CONCURRENCY", "16"))
+        
+        # Background jobs: worker tasks, max queued jobs and how long finished jobs are kept (seconds)
+        self.job_workers = int(os.environ.get("JOB_WORKERS", "8"))
+        self.job_max_queued = int(os.environ.get("JOB_MAX_QUEUED", "1000"))
+        self.job_retention = float(os.environ.get("JOB_RETENTION", "3600"))
+        
+        # Write one JSON line with the stage timings of every request (set TRACE_LOG=0 to disable)
+        self.trace_log = os.environ.get("TRACE_LOG", "1") != "0"
+        
         # Log configuration status (but don't expose actual keys)
         logger.info(f"OPENAI_API_KEY set: {'Yes' if self.openai_api_key else 'No'}")
         logger.info(f"GOOGLE_API_KEY set: {'Yes' if self.google_api_key else 'No'}")
@@ -36,17 +149,68 @@ class BaseRequest(BaseModel):
     google_api_key: Optional[str] = None
     search_engine_id: Optional[str] = None
 
-class ParseFileRequest(BaseRequest):
+class ParseOptions(BaseModel):
+    # PDF pages to extract, numbered from 1 (inclusive); ignored for DOCX
+    first_page: Optional[int] = None
+    last_page: Optional[int] = None
+    # Stop extracting once the text reaches this many characters
+    max_chars: Optional[int] = None
+    # Drop running headers, footers and page numbers that repeat across PDF pages
+    strip_headers: Optional[bool] = True
+
+class ParseFileRequest(BaseRequest, ParseOptions):
     file_path: str
 
+class UploadResponse(BaseModel):
+    document_id: str
+    file_name: str
+    size: int
+    text: str
+
 class PlagiarismRequest(BaseRequest):
     text: str
     similarity_threshold: Optional[int] = 40
+    max_queries: Optional[int] = None
 
-class GradeRequest(BaseRequest):
-    text: str
+class RubricRequest(BaseModel):
     rubric: str
+
+class ModelPolicy(BaseModel):
+    # Second model raced against the first when it is slower than usual ("" disables HEDGE_MODEL)
+    hedge_model: Optional[str] = None
+    # Models tried in order when a completion fails ([] disables FALLBACK_MODELS)
+    fallback_models: Optional[List[str]] = None
+
+class GradeRequest(BaseRequest, ModelPolicy):
+    text: str
+    # Either the rubric text or the ID of a rubric registered with POST /rubrics
+    rubric: Optional[str] = None
+    rubric_id: Optional[str] = None
     model: Optional[str] = "gpt-3.5-turbo"
+    bypass_cache: Optional[bool] = False
+    # None grades by sections only above LONG_DOCUMENT_TOKENS; True/False forces it on/off
+    sectioned: Optional[bool] = None
+
+class BatchItem(BaseModel):
+    id: Optional[str] = None
+    text: Optional[str] = None
+    document_id: Optional[str] = None
+
+class BatchGradeRequest(BaseRequest, ModelPolicy):
+    items: List[BatchItem]
+    rubric: Optional[str] = None
+    rubric_id: Optional[str] = None
+    model: Optional[str] = "gpt-3.5-turbo"
+    tool: Optional[str] = "grade_and_feedback"
+    max_concurrency: Optional[int] = None
+    bypass_cache: Optional[bool] = False
+    sectioned: Optional[bool] = None
+
+class SimilarSubmissionsRequest(BaseRequest):
+    text: Optional[str] = None
+    document_id: Optional[str] = None
+    top_k: Optional[int] = 5
+    min_similarity: Optional[float] = 0.3
 
 class ErrorResponse(BaseModel):
     detail: str
@@ -54,33 +218,748 @@ class ErrorResponse(BaseModel):
 class GradeResponse(BaseModel):
     grade: str
 
+class RubricResponse(BaseModel):
+    rubric_id: str
+    rubric: str
+
+class CriterionScore(BaseModel):
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+    
+    criterion: str
+    score: str
+    comment: Optional[str] = None
+
+class GradeFeedbackResponse(BaseModel):
+    model_config = ConfigDict(coerce_numbers_to_str=True)
+    
+    grade: str
+    criteria: List[CriterionScore] = []
+    feedback: str
+
+class BatchItemResult(BaseModel):
+    id: Optional[str] = None
+    status: str
+    result: Optional[Any] = None
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+
+class BatchGradeResponse(BaseModel):
+    results: List[BatchItemResult]
+    succeeded: int
+    failed: int
+
+class JobStatus(BaseModel):
+    job_id: str
+    tool: str
+    status: str
+    progress: float
+    error: Optional[str] = None
+    status_code: Optional[int] = None
+    created_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    # Milliseconds spent in each stage of the job
+    timings: Optional[Dict[str, float]] = None
+
+class QuotaUsage(BaseModel):
+    key_id: str
+    used: int
+    remaining: Optional[int] = None
+
+class SearchQuotaResponse(BaseModel):
+    day: str
+    daily_limit: int
+    keys: List[QuotaUsage]
+
+class RateLimitStatus(BaseModel):
+    upstream: str
+    key_id: str
+    requests_per_minute: Optional[float] = None
+    requests_available: Optional[float] = None
+    tokens_per_minute: Optional[float] = None
+    tokens_available: Optional[float] = None
+    rate_factor: float
+    paused_for: float
+
+class RateLimitsResponse(BaseModel):
+    limiters: List[RateLimitStatus]
+
+class SimilarSubmission(BaseModel):
+    document_id: str
+    similarity: float
+
+class SimilarSubmissionsResponse(BaseModel):
+    results: List[SimilarSubmission]
+
 class PlagiarismResult(BaseModel):
     url: str
     similarity: int
+    chunk_offset: Optional[int] = None
 
 class PlagiarismResponse(BaseModel):
     results: List[PlagiarismResult]
 
+# ==== ⏱️ Request Tracing ====
+# orjson decodes and encodes large texts several times faster than the json module; without it, fall back to json
+try:
+    import orjson
+    json_loads = orjson.loads
+    FastJSONResponse = ORJSONResponse
+except ImportError:
+    json_loads = json.loads
+    FastJSONResponse = JSONResponse
+
+# Seconds spent per stage of the current request (or job), shared with the tasks it starts
+_trace: ContextVar[Optional[Dict[str, float]]] = ContextVar("trace", default=None)
+_endpoint_marks: ContextVar[Optional[Dict[str, float]]] = ContextVar("endpoint_marks", default=None)
+trace_logger = logging.getLogger("server.trace")
+
+def add_span(name: str, seconds: float):
+    trace = _trace.get()
+    if trace is not None:
+        trace[name] = trace.get(name, 0.0) + seconds
+
+@contextmanager
+def span(name: str):
+    """Add the time spent in the block to the current trace; concurrent spans add up"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_span(name, time.perf_counter() - start)
+
+def trace_timings(trace: Dict[str, float]) -> Dict[str, float]:
+    return {name: round(seconds * 1000, 3) for name, seconds in trace.items()}
+
+def route_label(scope) -> str:
+    """Route template of a request; dispatcher and job routes get the tool name filled in
+    (known tools only, so label values stay bounded)"""
+    path = getattr(scope.get("route"), "path", "unmatched")
+    tool_name = scope.get("path_params", {}).get("tool_name")
+    if tool_name in JOB_TOOLS:
+        path = path.replace("{tool_name}", tool_name)
+    return path
+
+class TimedRoute(APIRoute):
+    """APIRoute that records the decode, validation and serialize spans of a request.
+    
+    FastAPI decodes, validates, calls the endpoint and serializes its result in one handler.
+    The JSON body of routes with a body model is decoded here first, with orjson, and cached on
+    the Request where FastAPI picks it up; the endpoint call is wrapped, so what lies between decoding and the endpoint
+    is validation, and what follows the endpoint is serialization. Endpoints that read the
+    body themselves (the tool dispatcher, uploads) record their own spans.
+    """
+    def get_route_handler(self):
+        endpoint = self.dependant.call
+        if asyncio.iscoroutinefunction(endpoint):
+            async def timed_endpoint(**values):
+                marks = _endpoint_marks.get()
+                if marks is not None:
+                    marks["start"] = time.perf_counter()
+                try:
+                    return await endpoint(**values)
+                finally:
+                    if marks is not None:
+                        marks["end"] = time.perf_counter()
+            self.dependant.call = timed_endpoint
+        handler = super().get_route_handler()
+        has_body = self.body_field is not None
+        
+        async def timed_handler(request: Request) -> Response:
+            if _trace.get() is None:
+                return await handler(request)
+            
+            marks: Dict[str, float] = {}
+            token = _endpoint_marks.set(marks)
+            start = time.perf_counter()
+            try:
+                content_type = request.headers.get("content-type", "")
+                if has_body and ("json" in content_type or not content_type):
+                    try:
+                        body = await request.body()
+                        if body:
+                            # Request.json() returns this instead of decoding again
+                            request._json = json_loads(body)
+                    except ValueError:
+                        pass  # Left for FastAPI to report
+                    add_span("decode", time.perf_counter() - start)
+                decoded = time.perf_counter()
+                response = await handler(request)
+            finally:
+                _endpoint_marks.reset(token)
+            if "start" in marks:
+                add_span("validation", marks["start"] - decoded)
+            if "end" in marks:
+                add_span("serialize", time.perf_counter() - marks["end"])
+            return response
+        
+        return timed_handler
+
+class TraceMiddleware:
+    """Starts a trace per request, returns its spans in a Server-Timing header and logs
+    them as one JSON line. Spans recorded while a streaming body is sent only reach the log."""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        trace: Dict[str, float] = {}
+        token = _trace.set(trace)
+        start = time.perf_counter()
+        status = 500
+        
+        async def send_with_timing(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                timings = trace_timings(trace)
+                timings["total"] = round((time.perf_counter() - start) * 1000, 3)
+                header = ", ".join(f"{name};dur={ms}" for name, ms in timings.items())
+                message = {**message, "headers": list(message.get("headers", [])) + [(b"server-timing", header.encode())]}
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _trace.reset(token)
+            if get_settings().trace_log:
+                trace_logger.info(json.dumps({
+                    "method": scope["method"],
+                    "route": route_label(scope),
+                    "status": status,
+                    "duration_ms": round((time.perf_counter() - start) * 1000, 3),
+                    "spans": trace_timings(trace),
+                }))
+
 # ==== 🚀 FastAPI Setup ====
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    open_http_client()
+    get_job_manager().start()
+    # Loading the similarity index rebuilds its band tables from SQLite, and tiktoken may download
+    # its encodings; do both before serving
+    await load_similarity_index()
+    settings = get_settings()
+    for model in dict.fromkeys(["gpt-3.5-turbo", settings.hedge_model] + settings.fallback_models):
+        if model:
+            await asyncio.to_thread(get_token_encoder, model)
+    yield
+    await get_job_manager().stop()
+    await close_http_client()
+    await close_openai_clients()
+    close_parse_pool()
+
 app = FastAPI(
     title="Assignment Grader API",
     description="API for parsing, grading, and checking plagiarism in academic assignments",
     version="1.0.0",
     responses={
         500: {"model": ErrorResponse}
-    }
+    },
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
+app.router.route_class = TimedRoute
+app.add_middleware(TraceMiddleware)
 
 @app.get("/")
 async def root():
     return {"message": "Assignment Grader API", "status": "running", "version": "1.0.0"}
 
+# ==== 📈 Metrics ====
+# Latency histogram bucket bounds in seconds, from fast cache hits up to long LLM calls
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+
+def format_labels(labels: Tuple[Tuple[str, str], ...]) -> str:
+    if not labels:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, v in labels)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(labels, escaped)) + "}"
+
+def format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(value)
+
+class Metrics:
+    """Counters and histograms kept in process, rendered in the Prometheus text format"""
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._series: Dict[str, Dict[Tuple, Any]] = {}
+    
+    def register(self, name: str, kind: str, help_text: str):
+        self._meta[name] = (kind, help_text)
+        self._series[name] = {}
+    
+    def inc(self, name: str, value: float = 1, **labels: str):
+        series = self._series[name]
+        key = tuple(labels.items())
+        series[key] = series.get(key, 0) + value
+    
+    def observe(self, name: str, value: float, **labels: str):
+        series = self._series[name]
+        key = tuple(labels.items())
+        entry = series.get(key)
+        if entry is None:
+            # Per-bucket counts (the last one is +Inf), sum, count
+            entry = series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        entry[0][bisect.bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+        entry[2] += 1
+    
+    def render(self) -> str:
+        lines = []
+        for name, (kind, help_text) in self._meta.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in self._series[name].items():
+                if kind != "histogram":
+                    lines.append(f"{name}{format_labels(key)} {format_value(value)}")
+                    continue
+                counts, total, count = value
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                    cumulative += bucket_count
+                    le = "+Inf" if bound == math.inf else format_value(bound)
+                    lines.append(f"{name}_bucket{format_labels(key + (('le', le),))} {cumulative}")
+                lines.append(f"{name}_sum{format_labels(key)} {format_value(total)}")
+                lines.append(f"{name}_count{format_labels(key)} {count}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.register("grader_requests_total", "counter", "HTTP requests by route and status code")
+metrics.register("grader_request_duration_seconds", "histogram", "HTTP request latency by route, until the response body is sent")
+metrics.register("grader_upstream_requests_total", "counter", "Upstream API calls (including retries) by upstream and status code")
+metrics.register("grader_upstream_duration_seconds", "histogram", "Upstream API call latency by upstream")
+metrics.register("grader_llm_tokens_total", "counter", "LLM tokens used by model and kind (prompt or completion)")
+metrics.register("grader_cache_lookups_total", "counter", "Cache lookups by cache and result (memory_hit, disk_hit or miss)")
+
+class MetricsMiddleware:
+    """Counts and times every HTTP request, labelled by route template rather than raw path"""
+    def __init__(self, app):
+        self.app = app
+    
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        
+        start = time.perf_counter()
+        status = 500
+        
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+        
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            path = route_label(scope)
+            metrics.inc("grader_requests_total", route=path, method=scope["method"], status=str(status))
+            metrics.observe("grader_request_duration_seconds", time.perf_counter() - start, route=path)
+
+app.add_middleware(MetricsMiddleware)
+
+@app.get("/metrics")
+async def get_metrics():
+    """Request, upstream, token and cache metrics in the Prometheus text format"""
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+# ==== 🌐 Shared HTTP Client ====
+_http_client: Optional[httpx.AsyncClient] = None
+
+def open_http_client() -> httpx.AsyncClient:
+    """Create the app-lifetime pooled HTTP client (called on startup)"""
+    global _http_client
+    if _http_client is None:
+        settings = get_settings()
+        _http_client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=settings.http_max_connections,
+                max_keepalive_connections=settings.http_max_keepalive
+            ),
+            timeout=settings.http_timeout
+        )
+    return _http_client
+
+def get_http_client() -> httpx.AsyncClient:
+    """Get the shared HTTP client, creating it if startup hooks did not run"""
+    return _http_client or open_http_client()
+
+async def close_http_client():
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+# ==== 🚦 Rate Limiting ====
+class TokenBucket:
+    """Budget refilled continuously from a per-minute rate, holding at most one minute's worth"""
+    def __init__(self, per_minute: float):
+        self.per_minute = per_minute
+        self.available = float(per_minute)
+        self._updated = time.monotonic()
+    
+    def refill(self, rate_factor: float = 1.0):
+        now = time.monotonic()
+        self.available = min(self.per_minute, self.available + (now - self._updated) * self.per_minute * rate_factor / 60)
+        self._updated = now
+
+class RateLimiter:
+    """Request and token budgets for one API key of one upstream, adapting to 429 responses.
+    
+    Callers queue in acquire() until both budgets cover their call. A 429 pauses the key for its
+    Retry-After (or the backoff delay), empties the request budget and halves the refill rate;
+    every successful call then wins back a little of the rate.
+    """
+    MIN_RATE_FACTOR = 0.1
+    RATE_RECOVERY = 0.02
+    
+    def __init__(self, requests_per_minute: float, tokens_per_minute: float = 0):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute > 0 else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute > 0 else None
+        self.rate_factor = 1.0
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+    
+    def _wait_time(self, tokens: int) -> float:
+        wait = self.paused_until - time.monotonic()
+        for bucket, amount in ((self.requests, 1), (self.tokens, tokens)):
+            if bucket is None:
+                continue
+            bucket.refill(self.rate_factor)
+            # A call bigger than the whole budget only waits for a full bucket
+            amount = min(amount, bucket.per_minute)
+            if bucket.available < amount:
+                wait = max(wait, (amount - bucket.available) * 60 / (bucket.per_minute * self.rate_factor))
+        return wait
+    
+    async def acquire(self, tokens: int = 0):
+        """Wait until the budgets allow one call using about this many tokens, then take them"""
+        async with self._lock:
+            while (wait := self._wait_time(tokens)) > 0:
+                await asyncio.sleep(wait)
+            if self.requests is not None:
+                self.requests.available -= 1
+            if self.tokens is not None:
+                self.tokens.available -= min(tokens, self.tokens.per_minute)
+    
+    def settle(self, reserved: int, used: int):
+        """Return tokens reserved for a call beyond what it actually used"""
+        if self.tokens is not None:
+            self.tokens.available = min(self.tokens.per_minute,
+                                        self.tokens.available + min(reserved, self.tokens.per_minute) - used)
+    
+    def record_success(self):
+        self.rate_factor = min(1.0, self.rate_factor + self.RATE_RECOVERY)
+    
+    def record_rate_limited(self, delay: float):
+        self.rate_factor = max(self.MIN_RATE_FACTOR, self.rate_factor / 2)
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+        if self.requests is not None:
+            self.requests.available = min(self.requests.available, 0)
+    
+    def status(self, upstream: str, key_id: str) -> RateLimitStatus:
+        self._wait_time(0)  # Refill both buckets before reporting
+        return RateLimitStatus(
+            upstream=upstream,
+            key_id=key_id,
+            requests_per_minute=self.requests.per_minute * self.rate_factor if self.requests else None,
+            requests_available=round(self.requests.available, 2) if self.requests else None,
+            tokens_per_minute=self.tokens.per_minute * self.rate_factor if self.tokens else None,
+            tokens_available=round(self.tokens.available) if self.tokens else None,
+            rate_factor=round(self.rate_factor, 3),
+            paused_for=round(max(0.0, self.paused_until - time.monotonic()), 2)
+        )
+
+class UpstreamError(Exception):
+    """A failed upstream call worth retrying (rate limited, server error or connection failure)"""
+    def __init__(self, status_code: int, detail: str, retry_after: Optional[float] = None):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+_rate_limiters: Dict[Tuple[str, str], RateLimiter] = {}
+
+def api_key_id(api_key: str) -> str:
+    """Short hash identifying an API key without exposing it"""
+    return hashlib.sha256(api_key.encode()).hexdigest()[:12]
+
+def get_rate_limiter(upstream: str, api_key: str) -> RateLimiter:
+    key = (upstream, api_key_id(api_key))
+    limiter = _rate_limiters.get(key)
+    if limiter is None:
+        settings = get_settings()
+        # Every worker process paces its own calls, so each gets an equal share of the budget
+        if upstream == "openai":
+            limiter = RateLimiter(settings.openai_rpm / settings.workers, settings.openai_tpm / settings.workers)
+        else:
+            limiter = RateLimiter(settings.google_qpm / settings.workers)
+        _rate_limiters[key] = limiter
+    return limiter
+
+def parse_retry_after(headers) -> Optional[float]:
+    """Seconds to wait according to Retry-After (seconds or HTTP date) or OpenAI's retry-after-ms"""
+    try:
+        if headers.get("retry-after-ms"):
+            return max(0.0, float(headers["retry-after-ms"]) / 1000)
+        value = headers.get("retry-after")
+        if not value:
+            return None
+        if value.strip().replace(".", "", 1).isdigit():
+            return float(value)
+        return max(0.0, (parsedate_to_datetime(value) - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt: int, retry_after: Optional[float] = None) -> float:
+    """Jittered exponential backoff, or the server's Retry-After plus a little jitter.
+    
+    The jitter keeps callers that were limited together from all retrying at the same moment.
+    """
+    settings = get_settings()
+    if retry_after is not None:
+        return retry_after + random.uniform(0, settings.upstream_backoff)
+    delay = min(settings.upstream_backoff_max, settings.upstream_backoff * 2 ** attempt)
+    return random.uniform(delay / 2, delay)
+
+async def rate_limited(upstream: str, api_key: str, send: Callable[[], Any], tokens: int = 0,
+                       max_retries: Optional[int] = None):
+    """Run an upstream call within the key's rate limits, retrying on UpstreamError.
+    
+    send() makes one attempt and raises UpstreamError for failures worth retrying. Once the
+    retries (UPSTREAM_MAX_RETRIES, or fewer with max_retries) are used up, or the server asks for
+    a wait longer than UPSTREAM_BACKOFF_MAX, the last failure is raised as an HTTPException with
+    its status code (429 when rate limited).
+    """
+    settings = get_settings()
+    limiter = get_rate_limiter(upstream, api_key)
+    retries = settings.upstream_max_retries if max_retries is None else min(max_retries, settings.upstream_max_retries)
+    for attempt in range(retries + 1):
+        with span("ratelimit"):
+            await limiter.acquire(tokens)
+        try:
+            result = await timed_upstream_call(upstream, send)
+            limiter.record_success()
+            return result
+        except UpstreamError as e:
+            delay = backoff_delay(attempt, e.retry_after)
+            if e.status_code == 429:
+                limiter.record_rate_limited(delay)
+            if attempt == retries or delay > settings.upstream_backoff_max:
+                raise HTTPException(status_code=e.status_code, detail=e.detail)
+            
+            logger.warning(f"{upstream} call failed ({e.status_code}), retrying in {delay:.1f}s")
+            # Rate-limited calls wait out the pause in acquire(), together with every other caller
+            if e.status_code != 429:
+                await asyncio.sleep(delay)
+
+async def timed_upstream_call(upstream: str, send: Callable[[], Any]):
+    """One upstream attempt, recorded in the upstream request metrics and the trace"""
+    start = time.perf_counter()
+    status = "error"
+    try:
+        result = await send()
+        status = "200"
+        return result
+    except (HTTPException, UpstreamError) as e:
+        status = str(e.status_code)
+        raise
+    finally:
+        metrics.inc("grader_upstream_requests_total", upstream=upstream, status=status)
+        metrics.observe("grader_upstream_duration_seconds", time.perf_counter() - start, upstream=upstream)
+        add_span("upstream", time.perf_counter() - start)
+
+@app.get("/rate_limits", response_model=RateLimitsResponse)
+async def rate_limits():
+    """Current budget headroom of each upstream API key in use (keys are shown as a short hash)"""
+    return RateLimitsResponse(limiters=[
+        limiter.status(upstream, key_id) for (upstream, key_id), limiter in _rate_limiters.items()
+    ])
+
+# ==== 🗄️ Caching ====
+MB = 1024 * 1024
+
+class MemoryCache:
+    """In-process LRU cache bounded by the total size of its values, with optional TTL"""
+    def __init__(self, max_bytes: int, ttl: Optional[float] = None):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, Optional[float]]]" = OrderedDict()
+        self._size = 0
+    
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at is not None and expires_at <= time.time():
+            self.delete(key)
+            return None
+        self._entries.move_to_end(key)
+        return value
+    
+    def set(self, key: str, value: str):
+        if len(value) > self.max_bytes:
+            return
+        self.delete(key)
+        self._entries[key] = (value, time.time() + self.ttl if self.ttl else None)
+        self._size += len(value)
+        while self._size > self.max_bytes:
+            _, (evicted, _) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+    
+    def delete(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[0])
+
+class SQLiteCache:
+    """Disk cache in a single SQLite file, evicting least recently used entries by size, with optional TTL.
+    
+    Several worker processes can share one file: the total size is kept in the database and
+    updated in the same transaction as each write.
+    """
+    def __init__(self, path: str, max_bytes: int, ttl: Optional[float] = None):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # WAL commits only need fsync at checkpoints; a crash loses at most the last few cache writes
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, accessed_at REAL NOT NULL, expires_at REAL)"
+        )
+        try:
+            # Cache files created before TTL support lack the expiry column
+            self._conn.execute("ALTER TABLE cache ADD COLUMN expires_at REAL")
+        except sqlite3.OperationalError:
+            pass
+        self._conn.execute("CREATE INDEX IF NOT EXISTS cache_accessed_at ON cache (accessed_at)")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER NOT NULL)")
+        self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        self._conn.execute("INSERT OR REPLACE INTO cache_size VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM cache))")
+        self._conn.commit()
+    
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            now = time.time()
+            row = self._conn.execute("SELECT value, size, expires_at FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, size, expires_at = row
+            if expires_at is not None and expires_at <= now:
+                # Another process may have replaced the entry since it was read
+                cursor = self._conn.execute("DELETE FROM cache WHERE key = ? AND expires_at = ?", (key, expires_at))
+                if cursor.rowcount:
+                    self._conn.execute("UPDATE cache_size SET size = size - ? WHERE id = 0", (size,))
+            else:
+                self._conn.execute("UPDATE cache SET accessed_at = ? WHERE key = ?", (now, key))
+            self._conn.commit()
+            return value if expires_at is None or expires_at > now else None
+    
+    def set(self, key: str, value: str):
+        if len(value) > self.max_bytes:
+            return
+        with self._lock:
+            now = time.time()
+            # Read and write in one transaction, so the size total stays exact with concurrent writers
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                old = self._conn.execute("SELECT size FROM cache WHERE key = ?", (key,)).fetchone()
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO cache (key, value, size, accessed_at, expires_at) VALUES (?, ?, ?, ?, ?)",
+                    (key, value, len(value), now, now + self.ttl if self.ttl else None)
+                )
+                self._conn.execute("UPDATE cache_size SET size = size + ? WHERE id = 0",
+                                   (len(value) - (old[0] if old else 0),))
+                if self._conn.execute("SELECT size FROM cache_size").fetchone()[0] > self.max_bytes:
+                    self._evict()
+                self._conn.commit()
+            except BaseException:
+                self._conn.rollback()
+                raise
+    
+    def _evict(self):
+        # Drop expired entries first, then evict down to 90% of the budget so we don't evict on every insert
+        self._conn.execute("DELETE FROM cache WHERE expires_at <= ?", (time.time(),))
+        size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        target = self.max_bytes * 0.9
+        evicted = []
+        for key, entry_size in self._conn.execute("SELECT key, size FROM cache ORDER BY accessed_at"):
+            if size <= target:
+                break
+            evicted.append((key,))
+            size -= entry_size
+        self._conn.executemany("DELETE FROM cache WHERE key = ?", evicted)
+        self._conn.execute("UPDATE cache_size SET size = ? WHERE id = 0", (size,))
+
+class TieredCache:
+    """Memory tier in front of an optional disk tier; disk hits are promoted to memory"""
+    def __init__(self, memory: MemoryCache, disk: Optional[SQLiteCache] = None, name: str = "cache"):
+        self.memory = memory
+        self.disk = disk
+        self.name = name
+    
+    async def get(self, key: str) -> Optional[str]:
+        with span("cache"):
+            value = self.memory.get(key)
+            result = "memory_hit"
+            if value is None:
+                result = "miss"
+                if self.disk is not None:
+                    value = await asyncio.to_thread(self.disk.get, key)
+                    if value is not None:
+                        result = "disk_hit"
+                        self.memory.set(key, value)
+        metrics.inc("grader_cache_lookups_total", cache=self.name, result=result)
+        return value
+    
+    async def set(self, key: str, value: str):
+        with span("cache"):
+            self.memory.set(key, value)
+            if self.disk is not None:
+                await asyncio.to_thread(self.disk.set, key, value)
+
+class SingleFlight:
+    """Coalesces concurrent calls with the same key into one.
+    
+    The first caller starts the call as a task; callers arriving while it runs await the
+    same task and get its result or exception. Nothing is kept once it finishes, so this
+    only removes duplicate in-flight work. A caller that is cancelled (e.g. the client
+    disconnects) does not cancel the shared call.
+    """
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+    
+    async def do(self, key: str, func: Callable[[], Any]) -> Any:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._finish(key, t))
+        return await asyncio.shield(task)
+    
+    def _finish(self, key: str, task: asyncio.Task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+        # Mark the exception as retrieved in case every caller was cancelled
+        if not task.cancelled():
+            task.exception()
+
 # Helper function to get the effective API keys
 def get_api_keys(request, settings):
     """Get API keys from request or environment"""
-    openai_key = getattr(request, "openai_api_key", None) or settings.openai_api_key
-    google_key = getattr(request, "google_api_key", None) or settings.google_api_key
-    search_id = getattr(request, "search_engine_id", None) or settings.search_engine_id
+    with span("keys"):
+        openai_key = getattr(request, "openai_api_key", None) or settings.openai_api_key
+        google_key = getattr(request, "google_api_key", None) or settings.google_api_key
+        search_id = getattr(request, "search_engine_id", None) or settings.search_engine_id
     
     return {
         "openai_api_key": openai_key,
@@ -89,28 +968,243 @@ def get_api_keys(request, settings):
     }
 
 # ==== 📄 File Parsing ====
-async def parse_pdf(file_path: str) -> str:
+# Bump when extraction output changes so cached documents are re-parsed
+PARSER_VERSION = "2"
+
+# Extraction is CPU-bound, so it runs in worker processes instead of on the event loop
+_parse_pool: Optional[ProcessPoolExecutor] = None
+_parse_pending = 0
+
+# Running headers and footers are looked for in the first and last lines of each page,
+# learned from a sample of pages spread over the range
+PDF_EDGE_LINES = 3
+PDF_SAMPLE_PAGES = 8
+
+def normalize_edge_line(line: str) -> str:
+    """Page numbers and dates change from page to page, so compare lines with digits masked"""
+    return re.sub(r"\d+", "#", " ".join(line.split()))
+
+def edge_line_indexes(lines: List[str]) -> List[int]:
+    """Indexes of the non-empty lines at the top and bottom of a page (at most a third of it at each end)"""
+    filled = [i for i, line in enumerate(lines) if line.strip()]
+    count = min(PDF_EDGE_LINES, len(filled) // 3)
+    return filled[:count] + filled[len(filled) - count:] if count else []
+
+def find_repeated_lines(doc, pages: range) -> set:
+    """Normalized edge lines found on at least half of a sample of the given pages"""
+    if len(pages) < 3:
+        return set()
+    sample = pages[::max(1, len(pages) // PDF_SAMPLE_PAGES)][:PDF_SAMPLE_PAGES]
+    counts = Counter()
+    for number in sample:
+        lines = doc[number].get_text().splitlines()
+        counts.update({normalize_edge_line(lines[i]) for i in edge_line_indexes(lines)})
+    threshold = max(2, len(sample) // 2)
+    return {line for line, count in counts.items() if count >= threshold}
+
+def iter_pdf_pages(doc, pages: range, strip_headers: bool = True):
+    """Yield the text of each page in turn, without its running header, footer and page number"""
+    # Learn headers from the whole document, so they are found even for a short page range
+    repeated = find_repeated_lines(doc, range(len(doc))) if strip_headers else set()
+    for number in pages:
+        text = doc[number].get_text()
+        if repeated:
+            lines = text.splitlines()
+            drop = {i for i in edge_line_indexes(lines) if normalize_edge_line(lines[i]) in repeated}
+            text = "\n".join(line for i, line in enumerate(lines) if i not in drop)
+        yield text
+
+# Extractors take a file path, or the file contents as bytes for in-memory uploads
+def extract_pdf_text(source: Union[str, bytes], first_page: Optional[int] = None, last_page: Optional[int] = None,
+                     max_chars: Optional[int] = None, strip_headers: bool = True) -> str:
+    import fitz  # PyMuPDF - Import only when needed
+    doc = fitz.open(stream=source, filetype="pdf") if isinstance(source, bytes) else fitz.open(source)
+    with doc:
+        pages = range(max(1, first_page or 1) - 1, min(doc.page_count, last_page or doc.page_count))
+        parts, size = [], 0
+        # Pages are read one at a time, so a max_chars cutoff skips the rest of the file
+        for text in iter_pdf_pages(doc, pages, strip_headers):
+            if max_chars is not None and size + len(text) >= max_chars:
+                parts.append(text[:max(0, max_chars - size)])
+                break
+            parts.append(text)
+            size += len(text) + 1
+        return "\n".join(parts)
+
+def extract_docx_text(source: Union[str, bytes], max_chars: Optional[int] = None) -> str:
+    from docx import Document  # Import only when needed
+    doc = Document(io.BytesIO(source) if isinstance(source, bytes) else source)
+    parts, size = [], 0
+    for paragraph in doc.paragraphs:
+        text = paragraph.text
+        if max_chars is not None and size + len(text) >= max_chars:
+            parts.append(text[:max(0, max_chars - size)])
+            break
+        parts.append(text)
+        size += len(text) + 1
+    return "\n".join(parts)
+
+def get_parse_pool() -> ProcessPoolExecutor:
+    global _parse_pool
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=get_settings().parse_workers)
+    return _parse_pool
+
+def close_parse_pool():
+    global _parse_pool
+    if _parse_pool is not None:
+        _parse_pool.shutdown(wait=False, cancel_futures=True)
+        _parse_pool = None
+
+def recycle_parse_pool(pool: ProcessPoolExecutor):
+    """Kill the pool's workers and start a new pool on next use.
+    
+    A running extraction cannot be cancelled, so this is the only way to free a worker stuck on a file.
+    """
+    global _parse_pool
+    if _parse_pool is pool:
+        _parse_pool = None
+    # ProcessPoolExecutor has no public way to stop a busy worker
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    # Files still queued in the pool are not cancelled: they fail with BrokenProcessPool once
+    # the pool notices its dead workers, and run_in_parse_pool resubmits them
+    pool.shutdown(wait=False)
+
+def release_parse_slot():
+    global _parse_pending
+    _parse_pending -= 1
+
+def submit_to_parse_pool(pool: ProcessPoolExecutor, func, source: Union[str, bytes], *args) -> Future:
+    """Submit a file, holding a queue slot until the pool is done with it (not when the caller stops waiting)"""
+    global _parse_pending
+    loop = asyncio.get_running_loop()
+    future = pool.submit(func, source, *args)
+    _parse_pending += 1
+    
+    def release(_):
+        try:
+            loop.call_soon_threadsafe(release_parse_slot)
+        except RuntimeError:
+            pass  # Event loop already closed
+    
+    future.add_done_callback(release)
+    return future
+
+async def run_in_parse_pool(func, source: Union[str, bytes], *args) -> str:
+    """Run an extraction function in the process pool, enforcing queue depth and timeout.
+    
+    A file that times out has its pool killed and replaced, so it cannot hold a worker. Other
+    files that were in the killed pool are resubmitted to the new one within their own timeout.
+    """
+    settings = get_settings()
+    
+    if _parse_pending >= settings.parse_max_queue:
+        raise HTTPException(status_code=503, detail="Too many documents queued for parsing, try again shortly")
+    
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.parse_timeout
+    with span("parse"):
+        while True:
+            if loop.time() >= deadline:
+                raise HTTPException(status_code=504, detail=f"Parsing timed out after {settings.parse_timeout:g}s")
+            pool = get_parse_pool()
+            try:
+                future = submit_to_parse_pool(pool, func, source, *args)
+                return await asyncio.wait_for(asyncio.wrap_future(future), timeout=max(0.0, deadline - loop.time()))
+            except asyncio.TimeoutError:
+                # A file still waiting in the queue is simply cancelled; one being parsed takes its pool down
+                if not future.cancel():
+                    recycle_parse_pool(pool)
+                raise HTTPException(status_code=504, detail=f"Parsing timed out after {settings.parse_timeout:g}s")
+            except BrokenProcessPool:
+                if _parse_pool is pool:
+                    # A worker died (e.g. a crash in the PDF library)
+                    recycle_parse_pool(pool)
+                    raise HTTPException(status_code=500, detail="Parser process crashed")
+                # Another file's timeout replaced the pool; try again in the new one
+
+def hash_file(file_path: str) -> str:
+    """SHA-256 of the file contents, used as the document ID"""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(MB), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+@lru_cache()
+def get_parse_cache() -> TieredCache:
+    settings = get_settings()
+    disk = None
+    if settings.parse_cache_disk_mb > 0:
+        disk = SQLiteCache(os.path.join(settings.cache_dir, "parse_cache.sqlite3"), settings.parse_cache_disk_mb * MB)
+    return TieredCache(MemoryCache(settings.parse_cache_memory_mb * MB), disk, name="parse")
+
+async def get_document_text(document_id: str) -> str:
+    """Look up the text of a previously parsed document by its ID"""
+    text = await get_parse_cache().get(f"{PARSER_VERSION}:{document_id}")
+    if text is None:
+        raise HTTPException(status_code=404, detail=f"Document not found: {document_id}. Parse the file again.")
+    return text
+
+async def parse_pdf(source: Union[str, bytes], options: ParseOptions) -> str:
     try:
-        import fitz  # PyMuPDF - Import only when needed
-        doc = fitz.open(file_path)
-        return "\n".join([page.get_text() for page in doc])
+        return await run_in_parse_pool(extract_pdf_text, source, options.first_page, options.last_page,
+                                       options.max_chars, options.strip_headers)
     except ImportError:
         raise HTTPException(status_code=500, detail="PyMuPDF not installed. Install with 'pip install pymupdf'")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error parsing PDF: {str(e)}")
 
-async def parse_docx(file_path: str) -> str:
+async def parse_docx(source: Union[str, bytes], options: ParseOptions) -> str:
     try:
-        from docx import Document  # Import only when needed
-        doc = Document(file_path)
-        return "\n".join([p.text for p in doc.paragraphs])
+        return await run_in_parse_pool(extract_docx_text, source, options.max_chars)
     except ImportError:
         raise HTTPException(status_code=500, detail="python-docx not installed. Install with 'pip install python-docx'")
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error parsing DOCX: {str(e)}")
 
+async def parse_document(source: Union[str, bytes], ext: str, document_id: str,
+                         options: Optional[ParseOptions] = None) -> str:
+    """Extract text from a file path or file bytes, cached by document ID and parse options.
+    
+    Only the text of the whole document (default options) can be looked up by document ID
+    later and is added to the similarity index; page ranges and cutoffs are cached separately.
+    """
+    options = ParseOptions(**options.model_dump(include=set(ParseOptions.model_fields))) if options is not None else ParseOptions()
+    options.strip_headers = options.strip_headers is not False
+    if options.first_page and options.last_page and options.first_page > options.last_page:
+        raise HTTPException(status_code=400, detail="first_page cannot be after last_page")
+    whole_document = options == ParseOptions()
+    
+    # Identical bytes always extract to the same text, so key the cache on content
+    cache = get_parse_cache()
+    cache_key = f"{PARSER_VERSION}:{document_id}"
+    if not whole_document:
+        cache_key += ":" + options.model_dump_json()
+    text = await cache.get(cache_key)
+    if text is None:
+        if ext == ".pdf":
+            text = await parse_pdf(source, options)
+        else:
+            text = await parse_docx(source, options)
+        await cache.set(cache_key, text)
+    
+    if whole_document:
+        await index_submission(document_id, text)
+    return text
+
 @app.post("/tools/parse_file", response_model=str)
-async def parse_file(request: ParseFileRequest, settings: Settings = Depends(get_settings)):
+async def parse_file(request: ParseFileRequest, settings: Settings = Depends(get_settings),
+                     response: Response = None):
+    return await read_file(request, settings, headers=response.headers if response is not None else None)
+
+async def read_file(request: ParseFileRequest, settings: Settings, headers: Optional[MutableHeaders] = None) -> str:
+    """Parse the file at request.file_path, adding its X-Document-ID to headers when given"""
     try:
         file_path = request.file_path
         
@@ -118,20 +1212,524 @@ async def parse_file(request: ParseFileRequest, settings: Settings = Depends(get
             raise HTTPException(status_code=404, detail=f"File not found: {file_path}")
             
         ext = os.path.splitext(file_path)[-1].lower()
-        
-        if ext == ".pdf":
-            return await parse_pdf(file_path)
-        elif ext == ".docx":
-            return await parse_docx(file_path)
-        else:
+        if ext not in (".pdf", ".docx"):
             raise HTTPException(status_code=400, detail=f"Unsupported file format: {ext}")
+        
+        document_id = await asyncio.to_thread(hash_file, file_path)
+        if headers is not None:
+            headers["X-Document-ID"] = document_id
+        
+        return await parse_document(file_path, ext, document_id, request)
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error parsing file: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error parsing file: {str(e)}")
 
+@app.post("/tools/upload_file", response_model=UploadResponse)
+async def upload_file(filename: str, request: Request, options: ParseOptions = Depends(),
+                      settings: Settings = Depends(get_settings)):
+    """Parse a file sent as the raw request body, e.g. POST /tools/upload_file?filename=essay.pdf
+    
+    Parse options (first_page, last_page, max_chars, strip_headers) go in the query string too.
+    
+    The body is read in chunks and hashed as it arrives. It stays in memory unless it
+    grows past UPLOAD_SPOOL_MB, in which case it is spooled to a temp file that is
+    removed once parsing finishes.
+    """
+    ext = os.path.splitext(filename)[-1].lower()
+    if ext not in (".pdf", ".docx"):
+        raise HTTPException(status_code=400, detail=f"Unsupported file format: {ext}")
+    
+    max_bytes = settings.upload_max_mb * MB
+    spool_bytes = settings.upload_spool_mb * MB
+    digest = hashlib.sha256()
+    buffer = bytearray()
+    spool_file = None
+    size = 0
+    
+    try:
+        async for chunk in request.stream():
+            size += len(chunk)
+            if size > max_bytes:
+                raise HTTPException(status_code=413, detail=f"File is larger than {settings.upload_max_mb} MB")
+            digest.update(chunk)
+            
+            if spool_file is None and len(buffer) + len(chunk) > spool_bytes:
+                spool_file = tempfile.NamedTemporaryFile(suffix=ext, delete=False)
+                spool_file.write(buffer)
+                buffer = bytearray()
+            if spool_file is not None:
+                spool_file.write(chunk)
+            else:
+                buffer.extend(chunk)
+        
+        if size == 0:
+            raise HTTPException(status_code=400, detail="Uploaded file is empty")
+        
+        if spool_file is not None:
+            spool_file.close()
+            source = spool_file.name
+        else:
+            source = bytes(buffer)
+        
+        document_id = digest.hexdigest()
+        text = await parse_document(source, ext, document_id, options)
+        return UploadResponse(document_id=document_id, file_name=filename, size=size, text=text)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error uploading file: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error uploading file: {str(e)}")
+    finally:
+        if spool_file is not None:
+            spool_file.close()
+            os.unlink(spool_file.name)
+
+# ==== 🔎 Submission Similarity Index ====
+MERSENNE_PRIME = (1 << 61) - 1
+MAX_HASH = (1 << 32) - 1
+
+class SimilarityIndex:
+    """MinHash signatures of submissions with an LSH band index, persisted to SQLite.
+    
+    Each document is shingled into word n-grams and reduced to a MinHash signature.
+    The signature is cut into bands; documents sharing any band are candidates, and
+    candidates are ranked by the fraction of equal signature values (estimated Jaccard
+    similarity). Band keys are kept in one sorted array per band, so a lookup is a
+    binary search, and new documents are merged into them in batches.
+    """
+    MERGE_BATCH = 1024
+    
+    def __init__(self, path: str, num_perm: int = 128, bands: int = 32, shingle_size: int = 5):
+        import numpy as np  # Import only when needed
+        self.np = np
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        
+        # Fixed seed: signatures stored on disk must stay comparable across restarts
+        rng = np.random.RandomState(42)
+        self._a = rng.randint(1, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._b = rng.randint(0, MERSENNE_PRIME, size=num_perm, dtype=np.uint64)
+        self._band_mix = rng.randint(1, MAX_HASH, size=self.rows, dtype=np.uint64)
+        
+        self._doc_ids: List[str] = []
+        self._positions: Dict[str, int] = {}
+        self._signatures = np.empty((1024, num_perm), dtype=np.uint32)
+        self._band_keys = np.empty((1024, bands), dtype=np.uint32)
+        self._sorted_keys = [np.empty(0, dtype=np.uint32) for _ in range(bands)]
+        self._sorted_docs = [np.empty(0, dtype=np.int32) for _ in range(bands)]
+        self._merged = 0  # documents before this position are in the sorted band arrays
+        
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("CREATE TABLE IF NOT EXISTS signatures (doc_id TEXT PRIMARY KEY, signature BLOB NOT NULL)")
+        self._conn.commit()
+        self._loaded_rowid = 0
+        self.refresh()
+    
+    def __len__(self) -> int:
+        return len(self._doc_ids)
+    
+    def __contains__(self, doc_id: str) -> bool:
+        return doc_id in self._positions
+    
+    def signature(self, text: str):
+        np = self.np
+        words = re.findall(r"\w+", text.lower())
+        k = min(self.shingle_size, len(words)) or 1
+        shingles = {" ".join(words[i:i + k]) for i in range(max(len(words) - k + 1, 1))}
+        hashes = np.fromiter((zlib.crc32(s.encode()) for s in shingles), dtype=np.uint64, count=len(shingles))
+        
+        signature = np.full(self.num_perm, MAX_HASH, dtype=np.uint64)
+        for start in range(0, len(hashes), 4096):
+            block = hashes[start:start + 4096]
+            # Universal hashing (a*x + b) mod p; uint64 overflow wraps, as in datasketch
+            permuted = (np.outer(block, self._a) + self._b) % MERSENNE_PRIME & MAX_HASH
+            np.minimum(signature, permuted.min(axis=0), out=signature)
+        return signature.astype(np.uint32)
+    
+    def _keys_for(self, signatures):
+        grouped = signatures.reshape(len(signatures), self.bands, self.rows).astype(self.np.uint64)
+        return ((grouped * self._band_mix).sum(axis=2) & MAX_HASH).astype(self.np.uint32)
+    
+    def _append(self, doc_id: str, signature):
+        position = len(self._doc_ids)
+        if position == len(self._signatures):
+            self._signatures = self.np.concatenate([self._signatures, self.np.empty_like(self._signatures)])
+            self._band_keys = self.np.concatenate([self._band_keys, self.np.empty_like(self._band_keys)])
+        self._signatures[position] = signature
+        self._band_keys[position] = self._keys_for(signature[None, :])[0]
+        self._doc_ids.append(doc_id)
+        self._positions[doc_id] = position
+        if position + 1 - self._merged >= self.MERGE_BATCH:
+            self._merge()
+    
+    def _merge(self):
+        np = self.np
+        end = len(self._doc_ids)
+        docs = np.arange(self._merged, end, dtype=np.int32)
+        for band in range(self.bands):
+            keys = self._band_keys[self._merged:end, band]
+            order = np.argsort(keys, kind="stable")
+            at = np.searchsorted(self._sorted_keys[band], keys[order])
+            self._sorted_keys[band] = np.insert(self._sorted_keys[band], at, keys[order])
+            self._sorted_docs[band] = np.insert(self._sorted_docs[band], at, docs[order])
+        self._merged = end
+    
+    def refresh(self):
+        """Load signatures added to the database since the last refresh (e.g. by another process)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT rowid, doc_id, signature FROM signatures WHERE rowid > ? ORDER BY rowid", (self._loaded_rowid,)
+            ).fetchall()
+            for rowid, doc_id, blob in rows:
+                if doc_id not in self._positions:
+                    self._append(doc_id, self.np.frombuffer(blob, dtype=self.np.uint32))
+                self._loaded_rowid = rowid
+    
+    def add(self, doc_id: str, text: str):
+        if doc_id in self._positions:
+            return
+        signature = self.signature(text)
+        with self._lock:
+            if doc_id in self._positions:
+                return
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO signatures (doc_id, signature) VALUES (?, ?)", (doc_id, signature.tobytes())
+            )
+            self._conn.commit()
+            self._append(doc_id, signature)
+            if cursor.lastrowid == self._loaded_rowid + 1:
+                self._loaded_rowid = cursor.lastrowid
+    
+    def query(self, text: Optional[str] = None, doc_id: Optional[str] = None,
+              top_k: int = 5, min_similarity: float = 0.0) -> List[Tuple[str, float]]:
+        """Nearest indexed documents by estimated Jaccard similarity, excluding doc_id itself"""
+        np = self.np
+        if doc_id not in self._positions and text is None:
+            return []
+        signature = self.signature(text) if doc_id not in self._positions else None
+        
+        with self._lock:
+            if signature is None:
+                signature = self._signatures[self._positions[doc_id]].copy()
+            keys = self._keys_for(signature[None, :])[0]
+            candidates = []
+            for band in range(self.bands):
+                sorted_keys = self._sorted_keys[band]
+                lo = np.searchsorted(sorted_keys, keys[band], side="left")
+                hi = np.searchsorted(sorted_keys, keys[band], side="right")
+                if hi > lo:
+                    candidates.append(self._sorted_docs[band][lo:hi])
+            # Documents not merged yet are compared band by band directly
+            end = len(self._doc_ids)
+            if end > self._merged:
+                unmerged = (self._band_keys[self._merged:end] == keys).any(axis=1)
+                candidates.append(np.nonzero(unmerged)[0].astype(np.int32) + self._merged)
+            if not candidates:
+                return []
+            
+            candidates = np.unique(np.concatenate(candidates))
+            similarities = (self._signatures[candidates] == signature).mean(axis=1)
+            doc_ids = [self._doc_ids[i] for i in candidates]
+        
+        ranked = sorted(zip(doc_ids, similarities.tolist()), key=lambda r: r[1], reverse=True)
+        return [(d, s) for d, s in ranked if d != doc_id and s >= min_similarity][:top_k]
+
+@lru_cache()
+def get_similarity_index() -> Optional[SimilarityIndex]:
+    settings = get_settings()
+    if not settings.similarity_index:
+        return None
+    try:
+        return SimilarityIndex(os.path.join(settings.cache_dir, "similarity_index.sqlite3"))
+    except ImportError:
+        logger.warning("numpy not installed, submission similarity index disabled")
+        return None
+
+async def load_similarity_index() -> Optional[SimilarityIndex]:
+    """get_similarity_index() in a worker thread, as the first call loads every stored signature"""
+    return await asyncio.to_thread(get_similarity_index)
+
+async def index_submission(document_id: str, text: str):
+    """Add a parsed submission to the similarity index"""
+    index = await load_similarity_index()
+    if index is None or document_id in index or not text.strip():
+        return
+    try:
+        await asyncio.to_thread(index.add, document_id, text)
+    except Exception as e:
+        logger.error(f"Error indexing document {document_id}: {str(e)}")
+
+@app.post("/tools/similar_submissions", response_model=SimilarSubmissionsResponse)
+async def similar_submissions(request: SimilarSubmissionsRequest, settings: Settings = Depends(get_settings)):
+    """Find previously parsed submissions similar to a text or parsed document"""
+    try:
+        index = await load_similarity_index()
+        if index is None:
+            raise HTTPException(status_code=500, detail="Similarity index disabled. Install numpy and set SIMILARITY_INDEX=1")
+        
+        if not request.document_id and not (request.text and request.text.strip()):
+            raise HTTPException(status_code=400, detail="Provide text or document_id")
+        if settings.workers > 1:
+            # Pick up submissions indexed by the other workers
+            await asyncio.to_thread(index.refresh)
+        if request.document_id and request.document_id not in index and not request.text:
+            raise HTTPException(status_code=404, detail=f"Document not indexed: {request.document_id}")
+        
+        matches = await asyncio.to_thread(
+            index.query, request.text, request.document_id,
+            request.top_k or 5, request.min_similarity or 0.0
+        )
+        return SimilarSubmissionsResponse(
+            results=[SimilarSubmission(document_id=d, similarity=round(s, 4)) for d, s in matches]
+        )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error finding similar submissions: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error finding similar submissions: {str(e)}")
+
 # ==== 📄 Plagiarism Checking ====
+STOPWORDS = frozenset("""a about above after again against all also am an and any are as at be because been
+before being below between both but by can could did do does doing down during each few for from further
+had has have having he her here hers him his how i if in into is it its itself just me more most my no nor
+not now of off on once only or other our ours out over own same she should so some such than that the their
+theirs them then there these they this those through to too under until up very was we were what when where
+which while who whom why will with would you your yours""".split())
+
+# Title pages, headers and reference lists are shared by many documents and make poor queries
+BOILERPLATE_PATTERN = re.compile(
+    r"\b(table of contents|references|bibliography|works cited|submitted (by|to)|student (id|name|number)|"
+    r"instructor|professor|course code|due date|word count|page \d+|all rights reserved|et al)\b",
+    re.IGNORECASE
+)
+
+def select_passages(text: str, max_passages: int, window: int = 2, max_words: int = 32) -> List[str]:
+    """Pick the most distinctive windows of consecutive sentences to use as search queries.
+    
+    A window scores higher the more of its words are long content words that are rare
+    within the document. Short windows, mostly-numeric windows, boilerplate and windows
+    scoring under half the best score are skipped. Chosen windows never overlap and are
+    returned in document order. Custom Search
+    ignores words past 32, so each window is cut to max_words.
+    """
+    sentences = [s.strip() for s in re.split(r"(?<=[.!?])\s+|\n\s*\n", text) if s.strip()]
+    counts = Counter(re.findall(r"[a-z']+", text.lower()))
+    total = sum(counts.values()) or 1
+    
+    scored = []
+    for start in range(len(sentences)):
+        words = " ".join(sentences[start:start + window]).split()[:max_words]
+        passage = " ".join(words)
+        tokens = re.findall(r"[a-z']+", passage.lower())
+        content = [t for t in tokens if t not in STOPWORDS and len(t) > 2]
+        if len(words) < 8 or len(content) < 5 or len(tokens) < len(words) * 0.6:
+            continue
+        if BOILERPLATE_PATTERN.search(passage):
+            continue
+        # Longer words are rarer in general English, so they weigh more
+        rarity = sum(math.log(total / counts[t]) * min(len(t) - 2, 8) / 8 for t in content) / len(tokens)
+        scored.append((rarity * len(content) / len(tokens), start, passage))
+    
+    chosen = []
+    used = set()
+    best = max((score for score, _, _ in scored), default=0)
+    for score, start, passage in sorted(scored, reverse=True):
+        covered = set(range(start, start + window))
+        if score < best / 2:
+            break
+        if covered & used:
+            continue
+        chosen.append((start, passage))
+        used |= covered
+        if len(chosen) == max_passages:
+            break
+    
+    if not chosen:
+        # Nothing distinctive (e.g. a very short text): fall back to the opening words
+        return [" ".join(text.split()[:max_words])]
+    return [passage for _, passage in sorted(chosen)]
+
+class SearchQuota:
+    """Daily Custom Search query counts per API key, stored in SQLite.
+    
+    Google resets the free quota at midnight Pacific Time, so days are counted there.
+    Keys are stored as a short hash, never in plain text.
+    """
+    def __init__(self, path: str, daily_limit: int):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.daily_limit = daily_limit
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS quota (day TEXT NOT NULL, key_id TEXT NOT NULL, used INTEGER NOT NULL, "
+            "PRIMARY KEY (day, key_id))"
+        )
+        self._conn.commit()
+    
+    @staticmethod
+    def today() -> str:
+        return datetime.now(ZoneInfo("America/Los_Angeles")).date().isoformat()
+    
+    @staticmethod
+    def key_id(api_key: str) -> str:
+        return api_key_id(api_key)
+    
+    def try_consume(self, api_key: str) -> bool:
+        """Count one query against today's quota; False if the quota is used up"""
+        day, key_id = self.today(), self.key_id(api_key)
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO quota (day, key_id, used) VALUES (?, ?, 0)", (day, key_id))
+            if self.daily_limit > 0:
+                cursor = self._conn.execute(
+                    "UPDATE quota SET used = used + 1 WHERE day = ? AND key_id = ? AND used < ?",
+                    (day, key_id, self.daily_limit)
+                )
+            else:
+                cursor = self._conn.execute(
+                    "UPDATE quota SET used = used + 1 WHERE day = ? AND key_id = ?", (day, key_id)
+                )
+            self._conn.commit()
+            return cursor.rowcount == 1
+    
+    def usage(self) -> SearchQuotaResponse:
+        day = self.today()
+        with self._lock:
+            rows = self._conn.execute("SELECT key_id, used FROM quota WHERE day = ? ORDER BY key_id", (day,)).fetchall()
+        return SearchQuotaResponse(
+            day=day,
+            daily_limit=self.daily_limit,
+            keys=[
+                QuotaUsage(key_id=key_id, used=used,
+                           remaining=max(self.daily_limit - used, 0) if self.daily_limit > 0 else None)
+                for key_id, used in rows
+            ]
+        )
+
+@lru_cache()
+def get_search_quota() -> SearchQuota:
+    settings = get_settings()
+    return SearchQuota(os.path.join(settings.cache_dir, "search_quota.sqlite3"), settings.google_daily_quota)
+
+@lru_cache()
+def get_search_cache() -> TieredCache:
+    settings = get_settings()
+    disk = None
+    if settings.search_cache_disk_mb > 0:
+        disk = SQLiteCache(
+            os.path.join(settings.cache_dir, "search_cache.sqlite3"),
+            settings.search_cache_disk_mb * MB,
+            ttl=settings.search_cache_ttl
+        )
+    return TieredCache(MemoryCache(settings.search_cache_memory_mb * MB, ttl=settings.search_cache_ttl), disk,
+                       name="search")
+
+def search_cache_key(query: str, search_engine_id: str) -> str:
+    normalized = " ".join(query.lower().split())
+    return hashlib.sha256(f"{search_engine_id}\0{normalized}".encode()).hexdigest()
+
+search_flights = SingleFlight()
+
+async def google_search(query: str, keys: Dict[str, str]) -> List[Dict[str, Any]]:
+    """Custom Search results for a query, served from the search cache when possible"""
+    cache = get_search_cache()
+    cache_key = search_cache_key(query, keys["search_engine_id"])
+    cached = await cache.get(cache_key)
+    if cached is not None:
+        return json.loads(cached)
+    
+    # Identical queries already in flight with the same API key share one upstream call (and one unit of quota)
+    flight_key = f"{api_key_id(keys['google_api_key'])}:{cache_key}"
+    return await search_flights.do(flight_key, lambda: fetch_search_results(query, keys, cache_key))
+
+async def fetch_search_results(query: str, keys: Dict[str, str], cache_key: str) -> List[Dict[str, Any]]:
+    """Run a Custom Search query upstream, counting it against the quota, and cache its results"""
+    if not await asyncio.to_thread(get_search_quota().try_consume, keys["google_api_key"]):
+        raise HTTPException(status_code=429, detail="Daily Google Custom Search quota used up")
+    
+    url = get_settings().google_search_url
+    params = {
+        "q": query,
+        "key": keys["google_api_key"],
+        "cx": keys["search_engine_id"]
+    }
+    
+    async def send() -> httpx.Response:
+        try:
+            response = await get_http_client().get(url, params=params)
+        except httpx.TransportError as e:
+            raise UpstreamError(502, f"Google API error: {str(e)}")
+        if response.status_code == 429 or response.status_code >= 500:
+            raise UpstreamError(response.status_code, f"Google API error: {response.text}",
+                                parse_retry_after(response.headers))
+        if response.status_code != 200:
+            raise HTTPException(status_code=response.status_code, 
+                              detail=f"Google API error: {response.text}")
+        return response
+    
+    response = await rate_limited("google", keys["google_api_key"], send)
+    items = response.json().get("items", [])
+    await get_search_cache().set(cache_key, json.dumps(items))
+    return items
+
+@app.get("/search/quota", response_model=SearchQuotaResponse)
+async def search_quota():
+    """Today's Custom Search usage per API key"""
+    return await asyncio.to_thread(get_search_quota().usage)
+
+def normalize_url(url: str) -> str:
+    return url.split("#", 1)[0].rstrip("/")
+
+def chunk_document(text: str, chunk_words: int = 40, stride: int = 20) -> Tuple[List[int], List[str]]:
+    """Overlapping word windows of a document and their character offsets.
+    
+    Windows are longer than a search snippet (~25 words) and overlap by half, and a last
+    window ends at the final word, so any snippet-sized region of the document lies entirely
+    inside some window.
+    """
+    words = list(re.finditer(r"\S+", text))
+    offsets, chunks = [], []
+    starts = list(range(0, max(len(words) - chunk_words, 0) + 1, stride))
+    if starts[-1] + chunk_words < len(words):
+        starts.append(len(words) - chunk_words)
+    for start in starts:
+        window = words[start:start + chunk_words]
+        if window:
+            offsets.append(window[0].start())
+            chunks.append(text[window[0].start():window[-1].end()])
+    return offsets, chunks
+
+def score_snippets(text: str, snippets: List[str], workers: int = -1, candidates: int = 8) -> List[Tuple[int, int]]:
+    """Best similarity (0-100) of each snippet against any chunk of the text, with that chunk's offset.
+    
+    All chunks are compared against all snippets in one multi-threaded RapidFuzz cdist call
+    using the cheap ratio scorer; the few best chunks per snippet are then rescored with
+    token_set_ratio, which ignores word order and extra words around the match.
+    """
+    from rapidfuzz import fuzz, process, utils  # Import only when needed
+    offsets, chunks = chunk_document(text)
+    if not chunks or not snippets:
+        return [(0, 0) for _ in snippets]
+    
+    chunks = [utils.default_process(c) for c in chunks]
+    snippets = [utils.default_process(s) for s in snippets]
+    prefilter = process.cdist(chunks, snippets, scorer=fuzz.ratio, workers=workers)
+    k = min(candidates, len(chunks))
+    shortlist = prefilter.argpartition(-k, axis=0)[-k:] if k < len(chunks) else prefilter.argsort(axis=0)
+    
+    results = []
+    for i, snippet in enumerate(snippets):
+        score, chunk = max((fuzz.token_set_ratio(chunks[c], snippet), c) for c in shortlist[:, i])
+        results.append((int(round(score)), offsets[chunk]))
+    return results
+
 @app.post("/tools/check_plagiarism", response_model=PlagiarismResponse)
 async def check_plagiarism(request: PlagiarismRequest, settings: Settings = Depends(get_settings)):
     try:
@@ -140,37 +1738,45 @@ async def check_plagiarism(request: PlagiarismRequest, settings: Settings = Depe
         
         if not keys["google_api_key"] or not keys["search_engine_id"]:
             raise HTTPException(status_code=500, detail="Google API key or Search Engine ID not configured")
-            
-        from fuzzywuzzy import fuzz  # Import only when needed
         
         text = request.text
         if not text.strip():
             raise HTTPException(status_code=400, detail="Text cannot be empty")
-            
-        # Take first 300 chars for the search query
-        query = text[:300].replace("\n", " ").strip()
         
-        url = f"https://www.googleapis.com/customsearch/v1"
-        params = {
-            "q": query,
-            "key": keys["google_api_key"],
-            "cx": keys["search_engine_id"]
-        }
+        # Search the most distinctive passages concurrently, within the per-document query budget
+        max_queries = max(1, min(request.max_queries or settings.plagiarism_max_queries, settings.plagiarism_max_queries))
+        queries = select_passages(text, max_queries)
+        responses = await asyncio.gather(*[google_search(q, keys) for q in queries], return_exceptions=True)
         
-        response = requests.get(url, params=params, timeout=10)
-        if response.status_code != 200:
-            raise HTTPException(status_code=response.status_code, 
-                              detail=f"Google API error: {response.text}")
-                              
-        data = response.json()
-        results = data.get("items", [])
+        errors = [r for r in responses if isinstance(r, Exception)]
+        if len(errors) == len(responses):
+            raise errors[0]
+        for error in errors:
+            logger.error(f"Plagiarism search query failed: {str(error)}")
+        
+        # Merge results from all queries, keeping every snippet seen for each page
+        links: Dict[str, str] = {}
+        snippet_keys: List[str] = []
+        snippets: List[str] = []
+        for items in responses:
+            if isinstance(items, Exception):
+                continue
+            for item in items:
+                key = normalize_url(item["link"])
+                links.setdefault(key, item["link"])
+                snippet_keys.append(key)
+                snippets.append(item.get("snippet", ""))
+        
+        # Score every snippet against every chunk of the document in one batch, off the event loop
+        scores = await asyncio.to_thread(score_snippets, text, snippets, settings.plagiarism_score_workers)
+        best: Dict[str, Tuple[int, int]] = {}
+        for key, score in zip(snippet_keys, scores):
+            if key not in best or score[0] > best[key][0]:
+                best[key] = score
         
         plagiarism_results = [
-            PlagiarismResult(
-                url=item["link"],
-                similarity=fuzz.token_set_ratio(text, item.get("snippet", ""))
-            )
-            for item in results
+            PlagiarismResult(url=links[key], similarity=similarity, chunk_offset=offset)
+            for key, (similarity, offset) in best.items()
         ]
         
         # Sort by similarity (highest first)
@@ -183,41 +1789,677 @@ async def check_plagiarism(request: PlagiarismRequest, settings: Settings = Depe
         
         return PlagiarismResponse(results=plagiarism_results)
     except ImportError:
-        raise HTTPException(status_code=500, detail="fuzzywuzzy not installed. Install with 'pip install fuzzywuzzy python-Levenshtein'")
+        raise HTTPException(status_code=500, detail="rapidfuzz not installed. Install with 'pip install rapidfuzz'")
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error checking plagiarism: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Error checking plagiarism: {str(e)}")
 
+# ==== 🤖 LLM Client ====
+# One AsyncOpenAI client per API key, so connections stay alive across requests
+_openai_clients: Dict[str, openai.AsyncOpenAI] = {}
+_llm_semaphore: Optional[asyncio.Semaphore] = None
+
+def get_openai_client(api_key: str) -> openai.AsyncOpenAI:
+    """Get (or create) the pooled async OpenAI client for an API key"""
+    client = _openai_clients.get(api_key)
+    if client is None:
+        settings = get_settings()
+        http_client = openai.DefaultAsyncHttpxClient(
+            limits=httpx.Limits(
+                max_connections=settings.llm_max_connections,
+                max_keepalive_connections=settings.llm_max_keepalive
+            ),
+            timeout=httpx.Timeout(settings.llm_timeout, connect=10.0)
+        )
+        # Retries are ours (see create_completion), so they respect the per-key rate limits
+        client = openai.AsyncOpenAI(api_key=api_key, base_url=settings.openai_base_url,
+                                    http_client=http_client, max_retries=0)
+        _openai_clients[api_key] = client
+    return client
+
+def get_llm_semaphore() -> asyncio.Semaphore:
+    """Semaphore capping concurrent LLM calls in this worker"""
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(get_settings().llm_max_concurrency)
+    return _llm_semaphore
+
+async def close_openai_clients():
+    clients = list(_openai_clients.values())
+    _openai_clients.clear()
+    for client in clients:
+        await client.close()
+
+async def create_completion(api_key: str, tokens: int, max_retries: Optional[int] = None, **params):
+    """chat.completions.create within the key's rate limits, retrying 429s and transient errors"""
+    client = get_openai_client(api_key)
+    
+    async def send():
+        try:
+            return await client.chat.completions.create(**params)
+        except openai.RateLimitError as e:
+            # An exhausted account quota will not recover by waiting
+            if e.code == "insufficient_quota":
+                raise HTTPException(status_code=429, detail=f"OpenAI API error: {str(e)}")
+            raise UpstreamError(429, f"OpenAI rate limit reached: {str(e)}", parse_retry_after(e.response.headers))
+        except openai.InternalServerError as e:
+            raise UpstreamError(500, f"OpenAI API error: {str(e)}", parse_retry_after(e.response.headers))
+        except openai.APIConnectionError as e:
+            raise UpstreamError(500, f"OpenAI API error: {str(e)}")
+    
+    return await rate_limited("openai", api_key, send, tokens, max_retries=max_retries)
+
+def record_token_usage(model: str, usage):
+    metrics.inc("grader_llm_tokens_total", usage.prompt_tokens or 0, model=model, kind="prompt")
+    metrics.inc("grader_llm_tokens_total", usage.completion_tokens or 0, model=model, kind="completion")
+
+def estimate_request_tokens(messages: List[Dict[str, str]], model: str, max_tokens: int) -> int:
+    """Tokens a call counts against the per-minute budget: the prompt plus the completion limit"""
+    return sum(count_tokens(m["content"], model) + 4 for m in messages) + max_tokens
+
+# Hedged and fallback completions: a completion still running after the usual latency for its model
+# and prompt is raced against the hedge model, and a failed one moves on to the next fallback model
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+
+class LatencyWindow:
+    """The most recent completion latencies per key, for percentile hedging deadlines"""
+    def __init__(self, size: int = LATENCY_WINDOW):
+        self.size = size
+        self._samples: Dict[Any, deque] = {}
+    
+    def record(self, key: Any, seconds: float):
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.size)
+        samples.append(seconds)
+    
+    def percentile(self, key: Any, q: float) -> Optional[float]:
+        """Nearest-rank percentile, or None until LATENCY_MIN_SAMPLES latencies are known"""
+        samples = self._samples.get(key)
+        if samples is None or len(samples) < LATENCY_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        return ordered[max(0, min(len(ordered) - 1, math.ceil(q / 100 * len(ordered)) - 1))]
+
+completion_latencies = LatencyWindow()
+metrics.register("grader_llm_hedges_total", "counter", "Hedged completions by model, hedge model, reason (slow or failed) and winner")
+metrics.register("grader_llm_fallbacks_total", "counter", "Failed completions handed to a fallback model, by model and fallback model")
+
+def model_policy(request: ModelPolicy, settings: Settings) -> ModelPolicy:
+    """The request's hedge and fallback models, with the server defaults for those it leaves unset"""
+    hedge_model = settings.hedge_model if request.hedge_model is None else request.hedge_model
+    fallback_models = settings.fallback_models if request.fallback_models is None else request.fallback_models
+    return ModelPolicy(hedge_model=hedge_model or None, fallback_models=[m for m in fallback_models if m])
+
+async def complete_with_policy(attempt: Callable[[str, Optional[int]], Awaitable[Any]], model: str,
+                               policy: Optional[ModelPolicy] = None, latency_key: Any = None) -> Tuple[str, Any]:
+    """Run attempt(model, max_retries) with hedging and fallbacks; returns the model that answered and its result.
+    
+    attempt should raise if its result is unusable, so only a valid answer wins a race. If the
+    model has not answered within HEDGE_PERCENTILE of its recent latencies for latency_key (or
+    fails before then), attempt(hedge_model) starts alongside it and the first valid answer is
+    used. If that fails too, the fallback models are tried in order.
+    A model with a hedge or fallback model after it gets only FALLBACK_MAX_RETRIES upstream retries
+    (max_retries), so a failing model hands over quickly; the last model gets the full
+    UPSTREAM_MAX_RETRIES (max_retries=None).
+    """
+    settings = get_settings()
+    
+    async def timed(attempt_model: str, max_retries: Optional[int]):
+        start = time.perf_counter()
+        try:
+            result = await attempt(attempt_model, max_retries)
+        except asyncio.CancelledError:
+            # A hedged-out attempt took at least this long; dropping it would hide the slow tail
+            completion_latencies.record((attempt_model, latency_key), time.perf_counter() - start)
+            raise
+        completion_latencies.record((attempt_model, latency_key), time.perf_counter() - start)
+        return result
+    
+    async def hedged(primary_model: str, hedge_model: str, hedge_retries: Optional[int]):
+        first = asyncio.ensure_future(timed(primary_model, settings.fallback_max_retries))
+        tasks = {first: primary_model}
+        reason, winner = None, "none"
+        try:
+            delay = completion_latencies.percentile((primary_model, latency_key), settings.hedge_percentile)
+            await asyncio.wait([first], timeout=settings.hedge_delay if delay is None else delay)
+            if first.done() and first.exception() is None:
+                return primary_model, first.result()
+            
+            reason = "failed" if first.done() else "slow"
+            tasks[asyncio.ensure_future(timed(hedge_model, hedge_retries))] = hedge_model
+            pending = {task for task in tasks if not task.done()}
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        winner = "primary" if task is first else "hedge"
+                        return tasks[task], task.result()
+            raise first.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            if reason is not None:
+                metrics.inc("grader_llm_hedges_total", model=primary_model, hedge_model=hedge_model,
+                            reason=reason, winner=winner)
+    
+    models = [model] + ((policy.fallback_models or []) if policy is not None else [])
+    hedge_model = policy.hedge_model if policy is not None else None
+    for i, current in enumerate(models):
+        max_retries = settings.fallback_max_retries if i + 1 < len(models) else None
+        try:
+            if i == 0 and hedge_model:
+                return await hedged(current, hedge_model, max_retries)
+            return current, await timed(current, max_retries)
+        except Exception as e:
+            if i + 1 == len(models):
+                raise
+            logger.warning(f"Completion with {current} failed, falling back to {models[i + 1]}: {str(e)}")
+            metrics.inc("grader_llm_fallbacks_total", model=current, fallback_model=models[i + 1])
+
+# ==== 📋 Rubric Registry ====
+def normalize_rubric(rubric: str) -> str:
+    """Canonical form of a rubric, so the same rubric always gives the same prompt prefix"""
+    return "\n".join(line.rstrip() for line in rubric.strip().splitlines())
+
+class RubricStore:
+    """Registered rubrics, stored in SQLite under a SHA-256 prefix of their normalized text"""
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._rubrics: Dict[str, str] = {}  # Rubrics are few and small, so keep every one looked up
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS rubrics (rubric_id TEXT PRIMARY KEY, rubric TEXT NOT NULL, created_at REAL NOT NULL)"
+        )
+        self._conn.commit()
+    
+    def add(self, rubric: str) -> str:
+        rubric = normalize_rubric(rubric)
+        rubric_id = hashlib.sha256(rubric.encode()).hexdigest()[:16]
+        with self._lock:
+            self._conn.execute("INSERT OR IGNORE INTO rubrics VALUES (?, ?, ?)", (rubric_id, rubric, time.time()))
+            self._conn.commit()
+            self._rubrics[rubric_id] = rubric
+        return rubric_id
+    
+    def get(self, rubric_id: str) -> Optional[str]:
+        rubric = self._rubrics.get(rubric_id)
+        if rubric is None:
+            with self._lock:
+                row = self._conn.execute("SELECT rubric FROM rubrics WHERE rubric_id = ?", (rubric_id,)).fetchone()
+            if row is not None:
+                rubric = self._rubrics[rubric_id] = row[0]
+        return rubric
+
+@lru_cache()
+def get_rubric_store() -> RubricStore:
+    return RubricStore(os.path.join(get_settings().cache_dir, "rubrics.sqlite3"))
+
+async def resolve_rubric(request: Union[GradeRequest, BatchGradeRequest]) -> str:
+    """Rubric text of a grading request, looked up in the registry when it gives a rubric_id"""
+    if request.rubric_id:
+        rubric = await asyncio.to_thread(get_rubric_store().get, request.rubric_id)
+        if rubric is None:
+            raise HTTPException(status_code=404, detail=f"Rubric not found: {request.rubric_id}")
+        return rubric
+    return normalize_rubric(request.rubric or "")
+
+@app.post("/rubrics", response_model=RubricResponse)
+async def register_rubric(request: RubricRequest):
+    """Store a rubric once; grading requests can then send its rubric_id instead of the text"""
+    try:
+        if not request.rubric.strip():
+            raise HTTPException(status_code=400, detail="Rubric cannot be empty")
+        
+        rubric_id = await asyncio.to_thread(get_rubric_store().add, request.rubric)
+        return RubricResponse(rubric_id=rubric_id, rubric=normalize_rubric(request.rubric))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error registering rubric: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error registering rubric: {str(e)}")
+
+@app.get("/rubrics/{rubric_id}", response_model=RubricResponse)
+async def get_rubric(rubric_id: str):
+    rubric = await asyncio.to_thread(get_rubric_store().get, rubric_id)
+    if rubric is None:
+        raise HTTPException(status_code=404, detail=f"Rubric not found: {rubric_id}")
+    return RubricResponse(rubric_id=rubric_id, rubric=rubric)
+
 # ==== 📄 Grading Functions ====
-async def call_openai_api(prompt: str, api_key: str, model: str = "gpt-3.5-turbo") -> str:
+class PromptTemplate:
+    """A grading prompt split into a static prefix and the per-submission part.
+    
+    Instructions and rubric go in the system message and the assignment comes last, so every
+    submission graded against one rubric starts with the same tokens and benefits from the
+    provider's prompt prefix cache.
+    """
+    def __init__(self, system: str, user: str = "Assignment: {text}"):
+        self.system = system
+        self.user = user
+    
+    def messages(self, rubric: str, text: str) -> List[Dict[str, str]]:
+        return [
+            {"role": "system", "content": compile_system_prompt(self.system, rubric)},
+            {"role": "user", "content": self.user.format(text=text)},
+        ]
+
+@lru_cache(maxsize=256)
+def compile_system_prompt(system: str, rubric: str) -> str:
+    return system.format(rubric=rubric)
+
+GRADE_PROMPT = PromptTemplate("""You are an academic grader. Grade the assignment the user sends based on the rubric.
+Respond with only the grade.
+
+Rubric: {rubric}""")
+
+FEEDBACK_PROMPT = PromptTemplate("""You are a teacher. Give constructive feedback to a student on the assignment the user sends, based on this rubric.
+
+Rubric: {rubric}""", "Assignment: {text}\n\nWrite your feedback below:")
+
+GRADE_FEEDBACK_PROMPT = PromptTemplate("""You are an academic grader. Grade the assignment the user sends based on the rubric and give the student constructive feedback.
+Respond with a JSON object with these fields:
+- "grade": the overall grade
+- "criteria": a list of objects with "criterion", "score" and "comment" for each rubric criterion
+- "feedback": constructive feedback for the student
+
+Rubric: {rubric}""")
+
+SECTION_PROMPT = PromptTemplate("""You are an academic grader. The user sends one section of a longer assignment.
+Assess this section against each rubric criterion: note its strengths, weaknesses and the evidence for them.
+Be concise and do not give an overall grade.
+
+Rubric: {rubric}""", "Assignment section: {text}")
+
+SECTION_MERGE_PROMPT = PromptTemplate("""You are an academic grader. The user sends assessments of consecutive sections of a longer assignment.
+Merge them into one concise assessment against each rubric criterion, keeping the main strengths, weaknesses and evidence.
+Do not give an overall grade.
+
+Rubric: {rubric}""", "Section assessments:{text}")
+
+SECTIONED_TEXT_NOTE = "The assignment is too long to include in full. These are assessments of each of its sections, in order:"
+
+# Chat models that reject response_format={"type": "json_object"} (base GPT-4 and the older GPT-3.5 snapshots);
+# for these the prompt alone asks for JSON
+JSON_MODE_UNSUPPORTED = re.compile(r"^(gpt-4(-32k)?(-0314|-0613)?|gpt-3\.5-turbo-16k|gpt-3\.5-turbo(-16k)?-(0301|0613))$")
+
+def supports_json_mode(model: str) -> bool:
+    return not JSON_MODE_UNSUPPORTED.match(model)
+
+def extract_json_object(text: str) -> str:
+    """The outermost {...} of a reply, dropping any prose or code fence around it"""
+    start, end = text.find("{"), text.rfind("}")
+    return text[start:end + 1] if start != -1 and end > start else text
+
+async def call_openai_api(prompt: Union[str, List[Dict[str, str]]], api_key: str, model: str = "gpt-3.5-turbo",
+                          max_tokens: int = 1024, temperature: float = 0.5, json_output: bool = False,
+                          max_retries: Optional[int] = None) -> str:
+    """Complete a prompt string (sent as one user message) or a list of chat messages.
+    
+    With json_output the model is put in JSON mode where it supports it; otherwise the JSON
+    object is cut out of the reply. max_retries caps the upstream retries below UPSTREAM_MAX_RETRIES.
+    """
     if not api_key:
         raise HTTPException(status_code=500, detail="OpenAI API key not configured")
         
     try:
-        # Create a client with the specified API key
-        client = openai.OpenAI(api_key=api_key)
-        
-        response = client.chat.completions.create(
-            model=model,
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1024,
-            temperature=0.5,
-        )
-        return response.choices[0].message.content.strip()
+        with span("prompt"):
+            messages = [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+            json_mode = json_output and supports_json_mode(model)
+            options = {"response_format": {"type": "json_object"}} if json_mode else {}
+            tokens = estimate_request_tokens(messages, model, max_tokens)
+        
+        async with get_llm_semaphore():
+            response = await create_completion(
+                api_key,
+                tokens,
+                max_retries,
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                **options
+            )
+        if response.usage is not None:
+            get_rate_limiter("openai", api_key).settle(tokens, response.usage.total_tokens)
+            record_token_usage(model, response.usage)
+        content = response.choices[0].message.content.strip()
+        return extract_json_object(content) if json_output and not json_mode else content
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
 
+async def stream_openai_api(prompt: Union[str, List[Dict[str, str]]], api_key: str, model: str = "gpt-3.5-turbo",
+                            max_tokens: int = 1024, temperature: float = 0.5, max_retries: Optional[int] = None):
+    """Like call_openai_api, but yields the completion text as it is generated"""
+    if not api_key:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    
+    try:
+        with span("prompt"):
+            messages = [{"role": "user", "content": prompt}] if isinstance(prompt, str) else prompt
+            tokens = estimate_request_tokens(messages, model, max_tokens)
+        
+        async with get_llm_semaphore():
+            # Only opening the stream is retried; a stream that fails midway fails the request
+            stream = await create_completion(
+                api_key,
+                tokens,
+                max_retries,
+                model=model,
+                messages=messages,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                stream=True,
+                stream_options={"include_usage": True},
+            )
+            start = time.perf_counter()
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                # With include_usage the final chunk carries the token counts and no choices
+                if getattr(chunk, "usage", None) is not None:
+                    record_token_usage(model, chunk.usage)
+            add_span("upstream", time.perf_counter() - start)
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"OpenAI API error: {str(e)}")
+
+@lru_cache()
+def get_result_cache() -> TieredCache:
+    settings = get_settings()
+    disk = None
+    if settings.result_cache_disk_mb > 0:
+        disk = SQLiteCache(
+            os.path.join(settings.cache_dir, "result_cache.sqlite3"),
+            settings.result_cache_disk_mb * MB,
+            ttl=settings.result_cache_ttl
+        )
+    return TieredCache(MemoryCache(settings.result_cache_memory_mb * MB, ttl=settings.result_cache_ttl), disk,
+                       name="result")
+
+def result_cache_key(template: PromptTemplate, text: str, rubric: str, model: str, **params) -> str:
+    """Hash every input that affects an LLM result"""
+    digest = hashlib.sha256()
+    for part in (template.system, template.user, text, rubric, model, json.dumps(params, sort_keys=True)):
+        digest.update(hashlib.sha256(part.encode()).digest())
+    return digest.hexdigest()
+
+completion_flights = SingleFlight()
+
+async def cached_completion(template: PromptTemplate, text: str, rubric: str, model: str, api_key: str,
+                            bypass_cache: bool = False, max_tokens: int = 1024, temperature: float = 0.5,
+                            json_output: bool = False, validate: Optional[Callable[[str], Any]] = None,
+                            policy: Optional[ModelPolicy] = None) -> str:
+    """Fill the prompt template and complete it, serving repeats from the result cache.
+    
+    With bypass_cache the cached result is ignored and replaced by a fresh one.
+    validate is called on fresh results before they are cached and should raise if they are unusable.
+    Concurrent identical calls share one upstream completion.
+    With a policy the completion is hedged and falls back as in complete_with_policy; results are
+    cached under the model that produced them, and a cached result from any of the policy's models is used.
+    """
+    cache = get_result_cache()
+    params = {"max_tokens": max_tokens, "temperature": temperature, "json_output": json_output}
+    cache_key = result_cache_key(template, text, rubric, model, **params)
+    if not bypass_cache:
+        result = await cache.get(cache_key)
+        if result is not None:
+            return result
+        if policy is not None:
+            for alternative in dict.fromkeys([policy.hedge_model] + (policy.fallback_models or [])):
+                if alternative and alternative != model:
+                    result = await cache.get(result_cache_key(template, text, rubric, alternative, **params))
+                    if result is not None:
+                        return result
+    
+    async def attempt(attempt_model: str, max_retries: Optional[int]) -> str:
+        with span("prompt"):
+            messages = template.messages(rubric, text)
+        result = await call_openai_api(messages, api_key, attempt_model, max_retries=max_retries, **params)
+        if validate is not None:
+            validate(result)
+        return result
+    
+    async def complete() -> str:
+        answered_by, result = await complete_with_policy(attempt, model, policy, latency_key=template)
+        await cache.set(result_cache_key(template, text, rubric, answered_by, **params), result)
+        return result
+    
+    # Calls are only shared per API key, so one key's failures and usage never land on another
+    return await completion_flights.do(f"{api_key_id(api_key)}:{cache_key}", complete)
+
+async def stream_cached_completion(template: PromptTemplate, text: str, rubric: str, model: str, api_key: str,
+                                   bypass_cache: bool = False, max_tokens: int = 1024, temperature: float = 0.5,
+                                   policy: Optional[ModelPolicy] = None):
+    """Streaming counterpart of cached_completion; a cached result is yielded in one piece.
+    
+    Streams are not hedged, but a stream that fails before sending any text falls back to the
+    policy's next fallback model.
+    """
+    cache = get_result_cache()
+    params = {"max_tokens": max_tokens, "temperature": temperature, "json_output": False}
+    if not bypass_cache:
+        result = await cache.get(result_cache_key(template, text, rubric, model, **params))
+        if result is not None:
+            yield result
+            return
+    
+    with span("prompt"):
+        messages = template.messages(rubric, text)
+    models = [model] + ((policy.fallback_models or []) if policy is not None else [])
+    for i, current in enumerate(models):
+        chunks = []
+        max_retries = get_settings().fallback_max_retries if i + 1 < len(models) else None
+        try:
+            async for chunk in stream_openai_api(messages, api_key, current, max_tokens=max_tokens,
+                                                 temperature=temperature, max_retries=max_retries):
+                chunks.append(chunk)
+                yield chunk
+            break
+        except Exception as e:
+            # Once text has been sent the stream cannot switch models
+            if chunks or i + 1 == len(models):
+                raise
+            logger.warning(f"Streaming completion with {current} failed, falling back to {models[i + 1]}: {str(e)}")
+            metrics.inc("grader_llm_fallbacks_total", model=current, fallback_model=models[i + 1])
+    await cache.set(result_cache_key(template, text, rubric, current, **params), "".join(chunks).strip())
+
+# Long documents are graded map-reduce style: each section is assessed on its own, concurrently,
+# and the grade/feedback prompts then run over the section assessments instead of the full text
+HEADING_PATTERN = re.compile(r"^(\d+(\.\d+)*\.?|[IVXLC]+\.|(chapter|section|part|appendix)\s+\w+)\s+\S", re.IGNORECASE)
+
+_token_encoder_failed = False
+
+@lru_cache()
+def get_token_encoder(model: str):
+    """tiktoken encoding for the model, or None if tiktoken is not installed or its encoding cannot be loaded"""
+    global _token_encoder_failed
+    if _token_encoder_failed:
+        return None
+    try:
+        # Import only when needed
+        import tiktoken
+    except ImportError:
+        return None
+    try:
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # tiktoken downloads an encoding on first use; without it, stop trying and estimate
+        _token_encoder_failed = True
+        logger.warning(f"Could not load tiktoken encoding for {model}, estimating token counts instead: {str(e)}")
+        return None
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """Count tokens locally; without tiktoken, estimate about 4 characters per token"""
+    encoder = get_token_encoder(model)
+    if encoder is None:
+        return len(text) // 4 + 1
+    return len(encoder.encode(text, disallowed_special=()))
+
+def is_heading(line: str) -> bool:
+    line = line.strip()
+    if not line or len(line.split()) > 12 or line[-1] in ".,;?!":
+        return False
+    return bool(HEADING_PATTERN.match(line)) or line.isupper() or line.istitle()
+
+def split_sections(text: str, max_tokens: int, model: str = "gpt-3.5-turbo") -> List[str]:
+    """Split a text into sections of at most max_tokens tokens.
+    
+    Paragraphs are kept whole where possible, and a heading starts a new section once
+    the current one is at least half full. Paragraphs longer than max_tokens are split by words.
+    """
+    paragraphs = [p.strip() for p in re.split(r"\n\s*\n", text) if p.strip()]
+    # Extracted PDF text often has no blank lines, so fall back to single lines
+    if len(paragraphs) <= 1:
+        paragraphs = [line.strip() for line in text.splitlines() if line.strip()]
+    
+    # Cut oversized paragraphs into half-section pieces, so they still pack with their heading
+    pieces = []
+    for paragraph in paragraphs:
+        tokens = count_tokens(paragraph, model)
+        if tokens <= max_tokens:
+            pieces.append((paragraph, tokens))
+            continue
+        words = paragraph.split()
+        step = max(1, len(words) * max_tokens // (2 * tokens))
+        for i in range(0, len(words), step):
+            piece = " ".join(words[i:i + step])
+            pieces.append((piece, count_tokens(piece, model)))
+    
+    sections, current, current_tokens = [], [], 0
+    for paragraph, tokens in pieces:
+        new_section = is_heading(paragraph.split("\n", 1)[0]) and current_tokens >= max_tokens // 2
+        if current and (new_section or current_tokens + tokens > max_tokens):
+            sections.append("\n\n".join(current))
+            current, current_tokens = [], 0
+        current.append(paragraph)
+        current_tokens += tokens
+    if current:
+        sections.append("\n\n".join(current))
+    return sections
+
+def format_assessments(parts: List[Tuple[int, int, str]], total: int) -> str:
+    """Section assessments as (first section, last section, assessment), one labelled block each"""
+    return "".join(
+        f"\n\nSection {first} of {total}:\n{text}" if first == last else f"\n\nSections {first}-{last} of {total}:\n{text}"
+        for first, last, text in parts
+    )
+
+def group_assessments(parts: List[Tuple[int, int, str]], max_tokens: int,
+                      model: str = "gpt-3.5-turbo") -> List[List[Tuple[int, int, str]]]:
+    """Pack neighbouring assessments into groups of about max_tokens, at least two to a group"""
+    groups, current, current_tokens = [], [], 0
+    for part in parts:
+        tokens = count_tokens(part[2], model)
+        if len(current) >= 2 and current_tokens + tokens > max_tokens:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(part)
+        current_tokens += tokens
+    if len(current) == 1 and groups:
+        groups[-1].extend(current)
+    else:
+        groups.append(current)
+    return groups
+
+async def condense_long_text(text: str, rubric: str, model: str, api_key: str,
+                             sectioned: Optional[bool] = None, bypass_cache: bool = False,
+                             policy: Optional[ModelPolicy] = None) -> str:
+    """Replace a long text with per-section assessments the grading prompts can run over.
+    
+    With sectioned=None this only happens above LONG_DOCUMENT_TOKENS; short texts are returned unchanged.
+    When the assessments together are still over LONG_DOCUMENT_TOKENS, neighbouring ones are merged
+    in further rounds until they fit. All of these go through the result cache like any other completion.
+    """
+    settings = get_settings()
+    if sectioned is False:
+        return text
+    if sectioned is None and await asyncio.to_thread(count_tokens, text, model) <= settings.long_document_tokens:
+        return text
+    
+    with span("prompt"):
+        sections = await asyncio.to_thread(split_sections, text, settings.section_tokens, model)
+    if len(sections) <= 1:
+        return text
+    
+    total = len(sections)
+    assessments = await asyncio.gather(*[
+        cached_completion(SECTION_PROMPT, f"(Section {i} of {total})\n{section}", rubric, model, api_key,
+                          bypass_cache=bypass_cache, max_tokens=512, temperature=0.2, policy=policy)
+        for i, section in enumerate(sections, 1)
+    ])
+    parts = [(i, i, assessment) for i, assessment in enumerate(assessments, 1)]
+    condensed = format_assessments(parts, total)
+    # Every round at least halves the number of parts, so this ends with one part at the latest
+    while len(parts) > 1 and await asyncio.to_thread(count_tokens, condensed, model) > settings.long_document_tokens:
+        groups = await asyncio.to_thread(group_assessments, parts, settings.section_tokens, model)
+        merged = await asyncio.gather(*[
+            cached_completion(SECTION_MERGE_PROMPT, format_assessments(group, total), rubric, model, api_key,
+                              bypass_cache=bypass_cache, max_tokens=512, temperature=0.2, policy=policy)
+            for group in groups
+        ])
+        parts = [(group[0][0], group[-1][1], assessment) for group, assessment in zip(groups, merged)]
+        condensed = format_assessments(parts, total)
+    logger.info(f"Graded long text in {total} sections")
+    return SECTIONED_TEXT_NOTE + condensed
+
+def sse_event(event: str, data: Any) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def stream_tool_response(template: PromptTemplate, request: GradeRequest, settings: Settings) -> StreamingResponse:
+    """Validate a grading request and stream its completion as server-sent events.
+    
+    Emits "token" events with {"text": ...}, then "done", or "error" with the failure detail.
+    """
+    text = request.text
+    rubric = await resolve_rubric(request)
+    model = request.model or "gpt-3.5-turbo"
+    keys = get_api_keys(request, settings)
+    policy = model_policy(request, settings)
+    
+    if not text.strip() or not rubric.strip():
+        raise HTTPException(status_code=400, detail="Text and rubric cannot be empty")
+    
+    if not keys["openai_api_key"]:
+        raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+    
+    async def events():
+        try:
+            condensed = await condense_long_text(text, rubric, model, keys["openai_api_key"],
+                                                 request.sectioned, bool(request.bypass_cache), policy)
+            async for chunk in stream_cached_completion(template, condensed, rubric, model, keys["openai_api_key"],
+                                                        bypass_cache=bool(request.bypass_cache), policy=policy):
+                yield sse_event("token", {"text": chunk})
+            yield sse_event("done", {})
+        except HTTPException as e:
+            yield sse_event("error", {"detail": e.detail, "status_code": e.status_code})
+        except Exception as e:
+            logger.error(f"Error streaming completion: {str(e)}")
+            yield sse_event("error", {"detail": str(e), "status_code": 500})
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
 @app.post("/tools/grade_text", response_model=GradeResponse)
 async def grade_text(request: GradeRequest, settings: Settings = Depends(get_settings)):
     try:
         text = request.text
-        rubric = request.rubric
+        rubric = await resolve_rubric(request)
         model = request.model or "gpt-3.5-turbo"
         
         # Get API keys
         keys = get_api_keys(request, settings)
+        policy = model_policy(request, settings)
         
         if not text.strip() or not rubric.strip():
             raise HTTPException(status_code=400, detail="Text and rubric cannot be empty")
@@ -225,14 +2467,10 @@ async def grade_text(request: GradeRequest, settings: Settings = Depends(get_set
         if not keys["openai_api_key"]:
             raise HTTPException(status_code=500, detail="OpenAI API key not configured")
         
-        prompt = f"""You are an academic grader. Grade the following assignment based on the rubric. 
-Respond with only the grade:
-
-Rubric: {rubric}
-
-Assignment: {text}"""
-        
-        grade = await call_openai_api(prompt, keys["openai_api_key"], model)
+        text = await condense_long_text(text, rubric, model, keys["openai_api_key"],
+                                        request.sectioned, bool(request.bypass_cache), policy)
+        grade = await cached_completion(GRADE_PROMPT, text, rubric, model, keys["openai_api_key"],
+                                        bypass_cache=bool(request.bypass_cache), policy=policy)
         return GradeResponse(grade=grade)
     except HTTPException:
         raise
@@ -244,11 +2482,12 @@ Assignment: {text}"""
 async def generate_feedback(request: GradeRequest, settings: Settings = Depends(get_settings)):
     try:
         text = request.text
-        rubric = request.rubric
+        rubric = await resolve_rubric(request)
         model = request.model or "gpt-3.5-turbo"
         
         # Get API keys
         keys = get_api_keys(request, settings)
+        policy = model_policy(request, settings)
         
         if not text.strip() or not rubric.strip():
             raise HTTPException(status_code=400, detail="Text and rubric cannot be empty")
@@ -256,61 +2495,525 @@ async def generate_feedback(request: GradeRequest, settings: Settings = Depends(
         if not keys["openai_api_key"]:
             raise HTTPException(status_code=500, detail="OpenAI API key not configured")
         
-        prompt = f"""You are a teacher. Give constructive feedback to a student based on this rubric and assignment.
+        text = await condense_long_text(text, rubric, model, keys["openai_api_key"],
+                                        request.sectioned, bool(request.bypass_cache), policy)
+        feedback = await cached_completion(FEEDBACK_PROMPT, text, rubric, model, keys["openai_api_key"],
+                                           bypass_cache=bool(request.bypass_cache), policy=policy)
+        return feedback
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error generating feedback: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error generating feedback: {str(e)}")
 
-Rubric: {rubric}
+@app.post("/tools/grade_text/stream")
+async def grade_text_stream(request: GradeRequest, settings: Settings = Depends(get_settings)):
+    """Stream the grade as server-sent events"""
+    return await stream_tool_response(GRADE_PROMPT, request, settings)
 
-Assignment: {text}
+@app.post("/tools/generate_feedback/stream")
+async def generate_feedback_stream(request: GradeRequest, settings: Settings = Depends(get_settings)):
+    """Stream the feedback as server-sent events"""
+    return await stream_tool_response(FEEDBACK_PROMPT, request, settings)
 
-Write your feedback below:"""
+@app.post("/tools/grade_and_feedback", response_model=GradeFeedbackResponse)
+async def grade_and_feedback(request: GradeRequest, settings: Settings = Depends(get_settings)):
+    """Grade and give feedback in a single structured LLM call"""
+    try:
+        text = request.text
+        rubric = await resolve_rubric(request)
+        model = request.model or "gpt-3.5-turbo"
         
-        feedback = await call_openai_api(prompt, keys["openai_api_key"], model)
-        return feedback
+        # Get API keys
+        keys = get_api_keys(request, settings)
+        policy = model_policy(request, settings)
+        
+        if not text.strip() or not rubric.strip():
+            raise HTTPException(status_code=400, detail="Text and rubric cannot be empty")
+        
+        if not keys["openai_api_key"]:
+            raise HTTPException(status_code=500, detail="OpenAI API key not configured")
+        
+        text = await condense_long_text(text, rubric, model, keys["openai_api_key"],
+                                        request.sectioned, bool(request.bypass_cache), policy)
+        result = await cached_completion(GRADE_FEEDBACK_PROMPT, text, rubric, model, keys["openai_api_key"],
+                                         bypass_cache=bool(request.bypass_cache), max_tokens=1536,
+                                         json_output=True, validate=GradeFeedbackResponse.model_validate_json,
+                                         policy=policy)
+        return GradeFeedbackResponse.model_validate_json(result)
+    except ValidationError as e:
+        logger.error(f"Invalid structured output from model: {str(e)}")
+        raise HTTPException(status_code=502, detail=f"Model returned an invalid grade/feedback object: {str(e)}")
     except HTTPException:
         raise
     except Exception as e:
-        logger.error(f"Error generating feedback: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Error generating feedback: {str(e)}")
+        logger.error(f"Error grading with feedback: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error grading with feedback: {str(e)}")
+
+# ==== 📚 Batch Grading ====
+BATCH_TOOLS = {
+    "grade_text": grade_text,
+    "generate_feedback": generate_feedback,
+    "grade_and_feedback": grade_and_feedback,
+}
+
+async def run_grade_batch(request: BatchGradeRequest, settings: Settings,
+                          on_progress: Optional[Callable[[float], None]] = None) -> BatchGradeResponse:
+    """Grade many submissions against one rubric, fanning out with bounded concurrency.
+    
+    Each item has either text or the document_id of a parsed file. A failing item
+    is reported in its own result instead of failing the whole batch. on_progress
+    receives the fraction of items finished.
+    """
+    tool_name = request.tool or "grade_and_feedback"
+    tool = BATCH_TOOLS.get(tool_name)
+    
+    if tool is None:
+        raise HTTPException(status_code=400, detail=f"Tool {tool_name} cannot be batched")
+    if not request.items:
+        raise HTTPException(status_code=400, detail="Batch has no items")
+    if len(request.items) > settings.batch_max_items:
+        raise HTTPException(status_code=400, detail=f"Batch has more than {settings.batch_max_items} items")
+    rubric = await resolve_rubric(request)
+    if not rubric:
+        raise HTTPException(status_code=400, detail="Rubric cannot be empty")
+    
+    limit = max(1, min(request.max_concurrency or settings.batch_max_concurrency, settings.batch_max_concurrency))
+    semaphore = asyncio.Semaphore(limit)
+    keys = get_api_keys(request, settings)
+    finished = 0
+    
+    async def grade_item(item: BatchItem) -> BatchItemResult:
+        nonlocal finished
+        async with semaphore:
+            try:
+                if item.text is not None:
+                    text = item.text
+                elif item.document_id:
+                    text = await get_document_text(item.document_id)
+                else:
+                    raise HTTPException(status_code=400, detail="Item needs text or document_id")
+                
+                item_request = GradeRequest(text=text, rubric=rubric, model=request.model,
+                                            bypass_cache=request.bypass_cache, sectioned=request.sectioned,
+                                            hedge_model=request.hedge_model,
+                                            fallback_models=request.fallback_models, **keys)
+                result = await tool(item_request, settings)
+                return BatchItemResult(id=item.id, status="ok", result=result)
+            except HTTPException as e:
+                return BatchItemResult(id=item.id, status="error", error=str(e.detail), status_code=e.status_code)
+            except Exception as e:
+                logger.error(f"Error grading batch item {item.id}: {str(e)}")
+                return BatchItemResult(id=item.id, status="error", error=str(e), status_code=500)
+            finally:
+                finished += 1
+                if on_progress is not None:
+                    on_progress(finished / len(request.items))
+    
+    results = await asyncio.gather(*[grade_item(item) for item in request.items])
+    succeeded = sum(1 for r in results if r.status == "ok")
+    return BatchGradeResponse(results=results, succeeded=succeeded, failed=len(results) - succeeded)
+
+@app.post("/tools/grade_batch", response_model=BatchGradeResponse)
+async def grade_batch(request: BatchGradeRequest, settings: Settings = Depends(get_settings)):
+    try:
+        return await run_grade_batch(request, settings)
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error grading batch: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"Error grading batch: {str(e)}")
+
+# ==== 🧰 Tool Registry ====
+class Tool:
+    """A tool callable by name, with a validator for its request model built once up front"""
+    def __init__(self, request_model: type, handler: Callable[..., Awaitable[Any]]):
+        self.request_model = request_model
+        self.handler = handler
+        self.adapter = TypeAdapter(request_model)
+        # Handlers such as read_file add response headers to the headers they are passed
+        self.takes_headers = "headers" in inspect.signature(handler).parameters
+    
+    async def parse_request(self, request: Request):
+        """Decode the JSON body with orjson and validate it with the precompiled adapter"""
+        with span("decode"):
+            try:
+                body = json_loads(await request.body())
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid JSON body: {str(e)}")
+        with span("validation"):
+            try:
+                return self.adapter.validate_python(body)
+            except ValidationError as e:
+                raise HTTPException(status_code=422, detail=str(e))
+    
+    async def call(self, request: Request, settings: Settings) -> Response:
+        tool_request = await self.parse_request(request)
+        headers = None
+        if self.takes_headers:
+            headers = MutableHeaders()
+            result = await self.handler(tool_request, settings, headers=headers)
+        else:
+            result = await self.handler(tool_request, settings)
+        
+        if isinstance(result, Response):
+            return result
+        with span("serialize"):
+            response = FastJSONResponse(result.model_dump() if isinstance(result, BaseModel) else result)
+        if headers is not None:
+            response.headers.update(headers)
+        return response
+
+TOOLS: Dict[str, Tool] = {
+    "parse_file": Tool(ParseFileRequest, read_file),
+    "check_plagiarism": Tool(PlagiarismRequest, check_plagiarism),
+    "similar_submissions": Tool(SimilarSubmissionsRequest, similar_submissions),
+    "grade_text": Tool(GradeRequest, grade_text),
+    "generate_feedback": Tool(GradeRequest, generate_feedback),
+    "grade_and_feedback": Tool(GradeRequest, grade_and_feedback),
+    "grade_batch": Tool(BatchGradeRequest, grade_batch),
+}
+
+# ==== ⏳ Background Jobs ====
+# Tools that can be submitted as jobs: every registered tool, with grade_batch run directly
+# so the job can report its progress
+JOB_TOOLS: Dict[str, Tool] = {**TOOLS, "grade_batch": Tool(BatchGradeRequest, run_grade_batch)}
+
+# Seconds between status reads of a job that runs in another worker process, and the least time
+# between two progress-only writes of a job to the store
+JOB_POLL_INTERVAL = 0.5
+JOB_SAVE_INTERVAL = 0.5
+
+class Job:
+    """A tool call running in the background, polled by ID"""
+    def __init__(self, tool: str, request: BaseModel):
+        self.id = uuid.uuid4().hex
+        self.tool = tool
+        self.request = request
+        self.status = "queued"
+        self.progress = 0.0
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.status_code: Optional[int] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.timings: Optional[Dict[str, float]] = None
+        self.store: Optional["JobStore"] = None
+        self._changed = asyncio.Event()
+        # Latest store write of the job, whether it has yet to start, and when the last one started
+        self._write: Optional[asyncio.Future] = None
+        self._write_queued = False
+        self._saved_at = 0.0
+    
+    @property
+    def done(self) -> bool:
+        return self.status in ("succeeded", "failed")
+    
+    def watch(self) -> asyncio.Event:
+        """Event set on the next status or progress change"""
+        return self._changed
+    
+    def notify(self, throttle: bool = False):
+        if self.store is not None:
+            self.store.save(self, throttle=throttle)
+        self._changed.set()
+        self._changed = asyncio.Event()
+    
+    def set_progress(self, progress: float):
+        self.progress = progress
+        self.notify(throttle=True)
+    
+    def to_status(self) -> JobStatus:
+        return JobStatus(
+            job_id=self.id, tool=self.tool, status=self.status, progress=self.progress,
+            error=self.error, status_code=self.status_code, created_at=self.created_at,
+            started_at=self.started_at, finished_at=self.finished_at, timings=self.timings
+        )
+
+class JobStore:
+    """Job status and results in SQLite, so any worker process can answer for a job another one runs.
+    
+    Writes run in worker threads, chained per job so its updates land in order (the result is
+    only written once the job is done).
+    """
+    COLUMNS = ("job_id", "tool", "status", "progress", "error", "status_code",
+               "created_at", "started_at", "finished_at", "timings", "result")
+    
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, tool TEXT NOT NULL, status TEXT NOT NULL, "
+            "progress REAL NOT NULL, error TEXT, status_code INTEGER, created_at REAL NOT NULL, started_at REAL, "
+            "finished_at REAL, timings TEXT, result TEXT)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_finished_at ON jobs (finished_at)")
+        self._conn.commit()
+        self._writes = set()
+    
+    def save(self, job: Job, throttle: bool = False) -> asyncio.Future:
+        """Write the job in a worker thread after its earlier writes; returns the write's future.
+        
+        A write that has not started yet writes the job as it is when it starts, so it also
+        covers later saves. With throttle it starts no sooner than JOB_SAVE_INTERVAL after the last one.
+        """
+        if job._write_queued:
+            return job._write
+        delay = max(0.0, job._saved_at + JOB_SAVE_INTERVAL - time.monotonic()) if throttle else 0.0
+        job._write = asyncio.ensure_future(self._save_after(job, job._write, delay))
+        job._write_queued = True
+        self._writes.add(job._write)
+        job._write.add_done_callback(self._writes.discard)
+        return job._write
+    
+    async def _save_after(self, job: Job, previous: Optional[asyncio.Future], delay: float):
+        if previous is not None:
+            await asyncio.wait([previous])
+        if delay > 0:
+            await asyncio.sleep(delay)
+        job._write_queued = False
+        job._saved_at = time.monotonic()
+        row = (job.id, job.tool, job.status, job.progress, job.error, job.status_code, job.created_at,
+               job.started_at, job.finished_at, json.dumps(job.timings) if job.timings is not None else None)
+        try:
+            await asyncio.to_thread(self._write_row, row, job.result if job.done else None)
+        except Exception as e:
+            logger.error(f"Error saving job {job.id}: {str(e)}")
+    
+    def _write_row(self, row: tuple, result: Any):
+        row += (json.dumps(jsonable_encoder(result)) if result is not None else None,)
+        with self._lock:
+            self._conn.execute(f"INSERT OR REPLACE INTO jobs VALUES ({', '.join('?' * len(row))})", row)
+            self._conn.commit()
+    
+    async def flush(self):
+        """Wait for every write started so far"""
+        while self._writes:
+            await asyncio.wait(list(self._writes))
+    
+    def load(self, job_id: str) -> Optional[Job]:
+        with self._lock:
+            row = self._conn.execute(f"SELECT {', '.join(self.COLUMNS)} FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        if row is None:
+            return None
+        values = dict(zip(self.COLUMNS, row))
+        job = Job(values["tool"], None)
+        job.id = values["job_id"]
+        for field in ("status", "progress", "error", "status_code", "created_at", "started_at", "finished_at"):
+            setattr(job, field, values[field])
+        job.timings = json.loads(values["timings"]) if values["timings"] else None
+        job.result = json.loads(values["result"]) if values["result"] else None
+        return job
+    
+    def prune(self, cutoff: float):
+        with self._lock:
+            self._conn.execute("DELETE FROM jobs WHERE finished_at < ?", (cutoff,))
+            self._conn.commit()
+    
+    async def prune_later(self, cutoff: float):
+        try:
+            await asyncio.to_thread(self.prune, cutoff)
+        except Exception as e:
+            logger.error(f"Error pruning jobs: {str(e)}")
+
+class JobManager:
+    """Queue of jobs drained by a fixed pool of worker tasks that outlive the submitting request.
+    
+    With a store, every job is mirrored to it and jobs run by other worker processes are read from it.
+    """
+    def __init__(self, settings: Settings, store: Optional[JobStore] = None):
+        self.settings = settings
+        self.store = store
+        self.jobs: Dict[str, Job] = {}
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._pruning: Optional[asyncio.Task] = None
+    
+    def start(self):
+        if self._workers:
+            return
+        self._queue = asyncio.Queue(maxsize=self.settings.job_max_queued)
+        self._workers = [asyncio.create_task(self._work()) for _ in range(self.settings.job_workers)]
+    
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+        if self.store is not None:
+            await self.store.flush()
+    
+    async def submit(self, tool: str, request: BaseModel) -> Job:
+        self.start()
+        self._prune()
+        job = Job(tool, request)
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise HTTPException(status_code=503, detail="Job queue is full, try again later")
+        self.jobs[job.id] = job
+        if self.store is not None:
+            job.store = self.store
+            # Written before the job ID is handed out, so every worker process can find it
+            await asyncio.shield(self.store.save(job))
+        return job
+    
+    async def get(self, job_id: str) -> Job:
+        """The job, or a snapshot of it from the store if another worker process runs it"""
+        job = self.jobs.get(job_id)
+        if job is None and self.store is not None:
+            job = await asyncio.to_thread(self.store.load, job_id)
+        if job is None:
+            raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+        return job
+    
+    def _prune(self):
+        cutoff = time.time() - self.settings.job_retention
+        expired = [job_id for job_id, job in self.jobs.items() if job.done and job.finished_at < cutoff]
+        for job_id in expired:
+            del self.jobs[job_id]
+        if self.store is not None and (self._pruning is None or self._pruning.done()):
+            self._pruning = asyncio.ensure_future(self.store.prune_later(cutoff))
+    
+    async def _work(self):
+        while True:
+            job = await self._queue.get()
+            try:
+                await self._run(job)
+            finally:
+                self._queue.task_done()
+    
+    async def _run(self, job: Job):
+        job.status = "running"
+        job.started_at = time.time()
+        job.notify()
+        trace = {"queue": job.started_at - job.created_at}
+        token = _trace.set(trace)
+        try:
+            if job.tool == "grade_batch":
+                job.result = await run_grade_batch(job.request, self.settings, on_progress=job.set_progress)
+            else:
+                job.result = await JOB_TOOLS[job.tool].handler(job.request, self.settings)
+            job.status = "succeeded"
+            job.progress = 1.0
+        except HTTPException as e:
+            job.status = "failed"
+            job.error = str(e.detail)
+            job.status_code = e.status_code
+        except Exception as e:
+            logger.error(f"Error running job {job.id}: {str(e)}")
+            job.status = "failed"
+            job.error = str(e)
+            job.status_code = 500
+        finally:
+            _trace.reset(token)
+            job.timings = trace_timings(trace)
+            job.finished_at = time.time()
+            job.notify()
+
+@lru_cache()
+def get_job_manager() -> JobManager:
+    settings = get_settings()
+    store = JobStore(os.path.join(settings.cache_dir, "jobs.sqlite3")) if settings.workers > 1 else None
+    return JobManager(settings, store)
+
+@app.post("/jobs/{tool_name}", response_model=JobStatus, status_code=202)
+async def submit_job(tool_name: str, request: Request):
+    """Queue a tool call and return its job ID immediately"""
+    if tool_name not in JOB_TOOLS:
+        raise HTTPException(status_code=404, detail=f"Tool {tool_name} not found")
+    
+    job_request = await JOB_TOOLS[tool_name].parse_request(request)
+    return (await get_job_manager().submit(tool_name, job_request)).to_status()
+
+@app.get("/jobs/{job_id}", response_model=JobStatus)
+async def get_job_status(job_id: str):
+    return (await get_job_manager().get(job_id)).to_status()
+
+@app.get("/jobs/{job_id}/result")
+async def get_job_result(job_id: str):
+    job = await get_job_manager().get(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=job.status_code or 500, detail=job.error)
+    if not job.done:
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is still {job.status}")
+    return job.result
+
+@app.get("/jobs/{job_id}/events")
+async def stream_job_events(job_id: str):
+    """Server-sent events with the job status on every change, ending when the job finishes"""
+    manager = get_job_manager()
+    job = await manager.get(job_id)
+    
+    async def events():
+        nonlocal job
+        last_status, idle = None, 0.0
+        while True:
+            changed = job.watch()
+            status = job.to_status().model_dump()
+            if status != last_status:
+                yield sse_event("status", status)
+                last_status, idle = status, 0.0
+            if job.done:
+                break
+            if job_id in manager.jobs:
+                try:
+                    await asyncio.wait_for(changed.wait(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                continue
+            # Another worker process runs the job, so poll its status from the store
+            await asyncio.sleep(JOB_POLL_INTERVAL)
+            idle += JOB_POLL_INTERVAL
+            if idle >= 15:
+                yield ": keep-alive\n\n"
+                idle = 0.0
+            job = await manager.get(job_id)
+    
+    return StreamingResponse(events(), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
 
 # ==== ✅ Support for alternative URL formats ====
 @app.post("/tool/{tool_name}")
-async def tool_endpoint_singular(tool_name: str, request: Request, settings: Settings = Depends(get_settings)):
+@app.post("/api/tools/{tool_name}")
+async def tool_endpoint(tool_name: str, request: Request, settings: Settings = Depends(get_settings)):
+    """Call any tool by name through the registry"""
+    tool = TOOLS.get(tool_name)
+    if tool is None:
+        raise HTTPException(status_code=404, detail=f"Tool {tool_name} not found")
+    
     try:
-        body = await request.json()
-        
-        if tool_name == "parse_file":
-            req = ParseFileRequest(**body)
-            return await parse_file(req, settings)
-        elif tool_name == "check_plagiarism":
-            req = PlagiarismRequest(**body)
-            return await check_plagiarism(req, settings)
-        elif tool_name == "grade_text":
-            req = GradeRequest(**body)
-            return await grade_text(req, settings)
-        elif tool_name == "generate_feedback":
-            req = GradeRequest(**body)
-            return await generate_feedback(req, settings)
-        else:
-            raise HTTPException(status_code=404, detail=f"Tool {tool_name} not found")
+        return await tool.call(request, settings)
     except HTTPException:
         raise
     except Exception as e:
         logger.error(f"Error in tool endpoint: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
-# Support for /api/tools/ endpoint
-@app.post("/api/tools/{tool_name}")
-async def tool_endpoint_api(tool_name: str, request: Request, settings: Settings = Depends(get_settings)):
-    return await tool_endpoint_singular(tool_name, request, settings)
-
 # ==== ✅ Run with uvicorn ====
 if __name__ == "__main__":
     logger.info("🚀 Assignment Grader API running at http://127.0.0.1:8088")
     logger.info("📚 Available tools:")
     logger.info("   - /tools/parse_file")
+    logger.info("   - /tools/upload_file")
     logger.info("   - /tools/check_plagiarism")
+    logger.info("   - /tools/similar_submissions")
     logger.info("   - /tools/grade_text")
     logger.info("   - /tools/generate_feedback")
+    logger.info("   - /tools/grade_and_feedback")
+    logger.info("   - /tools/grade_text/stream, /tools/generate_feedback/stream (server-sent events)")
+    logger.info("   - /tools/grade_batch")
+    logger.info("   - Background jobs: POST /jobs/{tool_name}, then GET /jobs/{job_id}[/result|/events]")
     logger.info("   - Alternative formats also supported: /tool/... and /api/tools/...")
     
-    uvicorn.run(app, host="0.0.0.0", port=8088)
\ No newline at end of file
+    workers = get_settings().workers
+    if workers > 1:
+        # Each worker process imports the app itself; caches, rubrics, quotas and jobs are shared through CACHE_DIR
+        logger.info(f"👷 Starting {workers} worker processes")
+        uvicorn.run("server:app", host="0.0.0.0", port=8088, workers=workers,
+                    app_dir=os.path.dirname(os.path.abspath(__file__)))
+    else:
+        uvicorn.run(app, host="0.0.0.0", port=8088)
\ No newline at end of file
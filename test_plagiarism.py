@@ -0,0 +1,24 @@
+from server import chunk_document, score_snippets
+
+# Regression checks for the plagiarism snippet matching; run with python test_plagiarism.py
+
+OPENING = " ".join(f"filler{i}" for i in range(40))
+CLOSING = "the industrial revolution transformed urban labour markets and reshaped family life across northern england"
+
+def test_closing_passage_is_matched():
+    text = f"{OPENING} {CLOSING}"
+    [(score, offset)] = score_snippets(text, [CLOSING])
+    assert score >= 90, f"closing passage scored {score}"
+    assert text[offset:].endswith(CLOSING)
+
+def test_windows_cover_every_word():
+    for length in (10, 40, 41, 56, 59, 60, 61, 100):
+        text = " ".join(f"w{i}" for i in range(length))
+        _, chunks = chunk_document(text)
+        covered = {word for chunk in chunks for word in chunk.split()}
+        assert covered == set(text.split()), f"{length} words: {len(text.split()) - len(covered)} not in any chunk"
+
+if __name__ == "__main__":
+    test_closing_passage_is_matched()
+    test_windows_cover_every_word()
+    print("✅ Plagiarism chunking checks passed")